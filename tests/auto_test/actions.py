@@ -3,15 +3,26 @@ import re
 
 import xmos.test.base as base
 import xmos.test.xmos_logging as xmos_logging
-from xmos.test.base import AllOf, OneOf, NoneOf, Sequence, Expected, getActiveProcesses
+from xmos.test.base import getActiveProcesses
 from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
 
 import analyzers
 import endpoints
 import generators
 import graph
+import latency
 import sequences
 import state
+import templates
+from templates import AllOf, OneOf, NoneOf, Sequence, Expected
+
+# The function used to wait for a period of time. The simulator replaces this so
+# that no time is spent sleeping.
+sleep = base.sleep
+
+def set_sleep_function(sleep_function):
+  global sleep
+  sleep = sleep_function
 
 def print_title(title):
   log_info("\n%s\n%s\n" % (title, '=' * len(title)))
@@ -65,12 +76,8 @@ def select_endpoint(args, endpoint_name):
 
 def check_set_clock_masters(args, test_step, expected):
   for loop in graph.get_loops(state.get_next()):
-    loop_master = loop[0]
-    for ep_name in loop:
-      # Look at the next state in case the node has just been set clock master
-      if state.get_next().is_clock_source_master(ep_name):
-        loop_master = ep_name
-        break
+    # Look at the next state in case the node has just been set clock master
+    loop_master = graph.get_loop_master(state.get_next(), loop)
 
     if not state.get_next().is_clock_source_master(loop_master):
       ep = endpoints.get(loop_master)
@@ -148,12 +155,14 @@ def controller_enumerate(args, avb_ep):
       command = "view descriptor %s %d" % (re.sub('\d*_', '', dtor, 1), index)
       args.master.sendLine(args.controller_id, command.encode('ascii', 'ignore'))
 
-def get_expected(args, test_step, src, src_stream, dst, dst_stream, command):
-  state.get_current().dump()
-  talker_state = state.get_current().get_talker_state(src, src_stream, dst, dst_stream, command)
+# The expected sequences for a connect/disconnect only depend on a small part of the
+# state, so they are kept as templates keyed by that part of the state
+expected_templates = templates.TemplateCache('connection', 1024)
+
+def build_expected(args, test_step, src, src_stream, dst, dst_stream, command,
+                   talker_state, listener_state, controller_state):
   talker_expect = sequences.expected_seq(talker_state)(test_step, args.user, src, src_stream, dst, dst_stream)
 
-  listener_state = state.get_current().get_listener_state(src, src_stream, dst, dst_stream, command)
   analyzer_state = "analyzer_" + listener_state
   analyzer_expect = sequences.expected_seq(analyzer_state)(test_step, src, src_stream, dst, dst_stream)
   analyzer_expect += sequences.analyzer_qav_seq(test_step, src, dst, command, args.user)
@@ -162,23 +171,50 @@ def get_expected(args, test_step, src, src_stream, dst, dst_stream, command):
     analyzer_expect = [AllOf(analyzer_expect)]
   listener_expect = sequences.expected_seq(listener_state)(test_step, dst, dst_stream, analyzer_expect)
 
-  controller_state = state.get_current().get_controller_state(args.controller_id,
-      src, src_stream, dst, dst_stream, command)
   controller_expect = sequences.expected_seq(controller_state)(args, test_step)
   return (talker_expect, listener_expect, controller_expect)
 
+def get_expected(args, test_step, src, src_stream, dst, dst_stream, command):
+  current = state.get_current()
+  current.dump()
+  talker_state = current.get_talker_state(src, src_stream, dst, dst_stream, command)
+  listener_state = current.get_listener_state(src, src_stream, dst, dst_stream, command)
+  controller_state = current.get_controller_state(args.controller_id,
+      src, src_stream, dst, dst_stream, command)
+
+  if listener_state == 'listener_disconnect':
+    sequences.analyzer_listener_disconnect_unregister_errors(dst)
+
+  # Everything from the state and configuration that the sequences depend on
+  path = graph.find_path(current, src, dst) or []
+  qav_analyzers = tuple(name for name in path
+      if analyzers.get(name) is not None and analyzers.get(name)['type'] == 'qav')
+  signature = (talker_state, listener_state, controller_state, command,
+               src, src_stream, dst, dst_stream, test_step.checkpoint is None,
+               bool(current.get_talker_on_count(src)), qav_analyzers,
+               args.user, args.controller_id, args.controller_type)
+
+  return expected_templates.get(signature, build_expected, args, test_step,
+      src, src_stream, dst, dst_stream, command, talker_state, listener_state, controller_state)
+
 def get_dual_port_nodes(nodes):
   return [node for node in nodes if endpoints.get(node)['ports'] == 2]
 
 def action_discover(args, test_step, expected, params_list):
+  visible_endpoints = graph.get_endpoints_connected_to(state.get_current(), args.controller_id)
+  controller = getActiveProcesses()[args.controller_id]
+
   if args.controller_type == 'c':
-    # Can take up to 20 seconds to timeout entities which have disappeared
-    yield base.sleep(20)
+    # Wait for the controller to be notified of exactly the visible entities. It can
+    # take up to 20 seconds to timeout entities which have disappeared.
+    guids = set(int(endpoints.guid_in_ascii(args.user, endpoints.get(name)), 16)
+                for name in visible_endpoints)
+    yield controller.wait_for_entities_available(guids, 20)
 
     print_title("Command: list")
     args.master.sendLine(args.controller_id, "list")
 
-    yield base.sleep(2)
+    yield controller.wait_for_listing(2)
 
   else:
     args.master.clearExpectHistory(args.controller_id)
@@ -188,8 +224,6 @@ def action_discover(args, test_step, expected, params_list):
     yield args.master.expect(Expected(args.controller_id, "Found \d+ entities", 15))
 
   # Actually check that the right number of entities have been seen
-  visible_endpoints = graph.get_endpoints_connected_to(state.get_current(), args.controller_id)
-  controller = getActiveProcesses()[args.controller_id]
   if len(controller.entities) != len(visible_endpoints):
     base.testError("Found %d entities, expecting %d" % (len(controller.entities), len(visible_endpoints)), critical=True)
   else:
@@ -222,12 +256,12 @@ def action_connect(args, test_step, expected, params_list):
   # Find the path between the src and dst and check whether there are any nodes between them
   forward_enable = []
   nodes = endpoints.get_path_endpoints(graph.find_path(state.get_current(), src, dst))
-  for node in get_dual_port_nodes(nodes):
-    if graph.node_will_see_stream_enable(state.get_current(), src, src_stream, dst, dst_stream, node):
-      forward_enable += sequences.expected_seq('stream_forward_enable')(test_step, args.user,
-        endpoints.get(node), endpoints.get(src))
-      forward_enable += sequences.expected_seq('port_shaper_connect')(test_step, endpoints.get(node),
-          src, src_stream, dst, dst_stream)
+  enabled = graph.get_forwarding_changes(state.get_current(), src, src_stream, dst, dst_stream, 'connect')
+  for node in get_dual_port_nodes(enabled):
+    forward_enable += sequences.expected_seq('stream_forward_enable')(test_step, args.user,
+      endpoints.get(node), endpoints.get(src))
+    forward_enable += sequences.expected_seq('port_shaper_connect')(test_step, endpoints.get(node),
+        src, src_stream, dst, dst_stream)
 
   # If there are any nodes in the chain then they must be seen to start forwarding before
   # the listener can be expected to see the stream
@@ -240,20 +274,18 @@ def action_connect(args, test_step, expected, params_list):
   else:
     listener_expect = []
 
-  # Expect not to see any enables from other nodes
+  # Expect not to see any enables from nodes outside the path
   not_forward_enable = []
-  temp_nodes = set(endpoints.get_all().keys()) - set(nodes)
-  for node in get_dual_port_nodes(temp_nodes):
-    not_forward_enable += sequences.expected_seq('stream_forward_enable')(test_step, args.user,
-      endpoints.get(node), endpoints.get(src))
+  other_nodes = get_dual_port_nodes(sorted(set(endpoints.get_all().keys()) - set(nodes)))
+  if test_step.checkpoint is None:
+    for node in other_nodes:
+      not_forward_enable += sequences.expected_seq('stream_forward_enable')(test_step, args.user,
+          endpoints.get(node), endpoints.get(src))
 
-  if not_forward_enable:
-    if test_step.checkpoint is None:
-      not_forward_enable = [NoneOf(not_forward_enable)]
-    else:
-      not_forward_enable = []
+    if not_forward_enable:
+      not_forward_enable = [templates.NoneOf(not_forward_enable)]
 
-  for node in get_dual_port_nodes(temp_nodes):
+  for node in other_nodes:
     not_forward_enable += sequences.expected_seq('port_shaper_connect')(test_step, endpoints.get(node),
           src, src_stream, dst, dst_stream)
 
@@ -264,8 +296,9 @@ def action_connect(args, test_step, expected, params_list):
 
   if test_step.do_checks and (talker_expect or listener_expect or controller_expect or
                               not_forward_enable or final_port_shaper_states):
-    expected += [AllOf(talker_expect + listener_expect + controller_expect +
-                       not_forward_enable + final_port_shaper_states)]
+    # Check all the guards against unwanted messages with one pattern per process
+    expected += [AllOf(sequences.merge_none_of(talker_expect + listener_expect + controller_expect +
+                       not_forward_enable + final_port_shaper_states))]
 
   yield args.master.expect(None)
 
@@ -283,12 +316,12 @@ def action_disconnect(args, test_step, expected, params_list):
   # Find the path between the src and dst and check whether there are any nodes between them
   forward_disable = []
   nodes = endpoints.get_path_endpoints(graph.find_path(state.get_current(), src, dst))
-  for node in get_dual_port_nodes(nodes):
-    if graph.node_will_see_stream_disable(state.get_current(), src, src_stream, dst, dst_stream, node):
-      forward_disable += sequences.expected_seq('stream_forward_disable')(test_step, args.user,
-        endpoints.get(node), endpoints.get(src))
-      forward_disable += sequences.expected_seq('port_shaper_disconnect')(test_step, endpoints.get(node),
-          src, src_stream, dst, dst_stream)
+  disabled = graph.get_forwarding_changes(state.get_current(), src, src_stream, dst, dst_stream, 'disconnect')
+  for node in get_dual_port_nodes(disabled):
+    forward_disable += sequences.expected_seq('stream_forward_disable')(test_step, args.user,
+      endpoints.get(node), endpoints.get(src))
+    forward_disable += sequences.expected_seq('port_shaper_disconnect')(test_step, endpoints.get(node),
+        src, src_stream, dst, dst_stream)
 
   # If there are any nodes in the chain then the forward disabling is expected before the
   # audio will be seen to be lost
@@ -301,20 +334,18 @@ def action_disconnect(args, test_step, expected, params_list):
   else:
     listener_expect = []
 
-  # Expect not to see any disables from other nodes
+  # Expect not to see any disables from nodes outside the path
   not_forward_disable = []
-  temp_nodes = set(endpoints.get_all().keys()) - set(nodes)
-  for node in get_dual_port_nodes(temp_nodes):
-    not_forward_disable += sequences.expected_seq('stream_forward_disable')(test_step, args.user,
-        endpoints.get(node), endpoints.get(src))
-
-  if not_forward_disable:
-    if test_step.checkpoint is None:
-      not_forward_disable = [NoneOf(not_forward_disable)]
-    else:
-      not_forward_disable = []
+  other_nodes = get_dual_port_nodes(sorted(set(endpoints.get_all().keys()) - set(nodes)))
+  if test_step.checkpoint is None:
+    for node in other_nodes:
+      not_forward_disable += sequences.expected_seq('stream_forward_disable')(test_step, args.user,
+          endpoints.get(node), endpoints.get(src))
+
+    if not_forward_disable:
+      not_forward_disable = [templates.NoneOf(not_forward_disable)]
 
-  for node in get_dual_port_nodes(temp_nodes):
+  for node in other_nodes:
     not_forward_disable += sequences.expected_seq('port_shaper_disconnect')(test_step, endpoints.get(node),
           src, src_stream, dst, dst_stream)
 
@@ -325,8 +356,9 @@ def action_disconnect(args, test_step, expected, params_list):
 
   if test_step.do_checks and (talker_expect or listener_expect or controller_expect or
                               not_forward_disable or final_port_shaper_states):
-    expected += [AllOf(talker_expect + listener_expect + controller_expect +
-                       not_forward_disable + final_port_shaper_states)]
+    # Check all the guards against unwanted messages with one pattern per process
+    expected += [AllOf(sequences.merge_none_of(talker_expect + listener_expect + controller_expect +
+                       not_forward_disable + final_port_shaper_states))]
 
   yield args.master.expect(None)
 
@@ -359,40 +391,78 @@ def action_ping(args, test_step, expected, params_list):
 
   yield args.master.expect(None)
 
+def relay_reroute_expected(args, test_step, before, after):
+  """ Build the expected forwarding and shaper changes for the streams which move to
+      a different path when a relay is opened or closed.
+  """
+  expected = []
+  for talker in sorted(graph.get_rerouted_talkers(before, after), key=str):
+    talker_ep = endpoints.get(talker.src)
+    old_nodes = graph.get_forwarding_nodes(before, talker)
+    new_nodes = graph.get_forwarding_nodes(after, talker)
+    for node in get_dual_port_nodes(sorted(new_nodes - old_nodes)):
+      expected += sequences.expected_seq('stream_forward_enable')(test_step, args.user,
+        endpoints.get(node), talker_ep)
+    for node in get_dual_port_nodes(sorted(old_nodes - new_nodes)):
+      expected += sequences.expected_seq('stream_forward_disable')(test_step, args.user,
+        endpoints.get(node), talker_ep)
+
+  for (node, port) in graph.get_changed_reservations(before, after):
+    if after.get_port_bandwidth(node, port) > before.get_port_bandwidth(node, port):
+      action = 'Increasing'
+    else:
+      action = 'Decreasing'
+    expected += sequences.port_shaper_change_seq(test_step, endpoints.get(node), port, action)
+
+  return expected
+
+def get_relay_lost_connections(relay_name):
+  """ Get the active connections which cross a relay and have no other path to take
+      once it has been opened in the next state.
+  """
+  lost = []
+  for c,n in state.get_current().active_connections.iteritems():
+    path = state.get_next().connection_paths.get(c)
+    if n and path and relay_name in path:
+      lost.append(c)
+  return lost
+
 def action_link_downup(args, test_step, expected, params_list):
   """ Expect all connections which bridge the relay to be lost and restored if there
       is a quick link down/up event. The first argument is the analyzer controlling
-      the relay. The second is the time to sleep before restoring the link.
+      the relay. The second is the time to sleep before restoring the link. Any
+      connections which have an alternative path are expected to move to it.
   """
   analyzer_name = choose_analyzer(params_list, 0)
   sleep_time = int(params_list[1])
 
-  lost = []
-  # Expect all the connections which cross the relay to be lost
-  for c,n in state.get_current().active_connections.iteritems():
-    if n and analyzer_name in graph.find_path(state.get_current(), c.talker.src, c.listener.dst):
-      lost += sequences.analyzer_listener_disconnect_seq(test_step,
-                      c.talker.src, c.talker.src_stream,
-                      c.listener.dst, c.listener.dst_stream)
-
   # Send the command to open the relay '(r)elay (o)pen'
   args.master.sendLine(analyzer_name, "r o")
   state.get_next().set_relay_open(analyzer_name)
 
+  # Expect all the connections which cross the relay to be lost
+  lost_connections = get_relay_lost_connections(analyzer_name)
+  lost = relay_reroute_expected(args, test_step, state.get_current(), state.get_next())
+  for c in lost_connections:
+    sequences.analyzer_listener_disconnect_unregister_errors(c.listener.dst)
+    lost += sequences.analyzer_listener_disconnect_seq(test_step,
+                    c.talker.src, c.talker.src_stream,
+                    c.listener.dst, c.listener.dst_stream)
+
   if test_step.do_checks and lost:
     expected += [AllOf(lost)]
 
   # Perform a sleep as defined by the second argument
-  yield base.sleep(sleep_time)
+  yield sleep(sleep_time)
 
-  found = []
   # Expect all the connections which cross the relay to be restored
+  opened_state = state.get_next().copy()
   state.get_next().set_relay_closed(analyzer_name)
-  for c,n in state.get_current().active_connections.iteritems():
-    if n and analyzer_name in graph.find_path(state.get_current(), c.talker.src, c.listener.dst):
-      found += sequences.analyzer_listener_connect_seq(test_step,
-                      c.talker.src, c.talker.src_stream,
-                      c.listener.dst, c.listener.dst_stream)
+  found = relay_reroute_expected(args, test_step, opened_state, state.get_next())
+  for c in lost_connections:
+    found += sequences.analyzer_listener_connect_seq(test_step,
+                    c.talker.src, c.talker.src_stream,
+                    c.listener.dst, c.listener.dst_stream)
 
   # Send the command to close the relay '(r)elay (c)lose'
   args.master.sendLine(analyzer_name, "r c")
@@ -410,40 +480,38 @@ def action_link_up(args, test_step, expected, params_list):
   state.get_next().set_relay_closed(analyzer_name)
 
   # Always allow time for the relay to actually be opened
-  yield base.sleep(0.1)
+  yield sleep(0.1)
 
 def action_link_down(args, test_step, expected, params_list):
   analyzer_name = choose_analyzer(params_list, 0)
 
-  checks = []
+  # Send the command to open the relay '(r)elay (o)pen'
+  args.master.sendLine(analyzer_name, "r o")
+  state.get_next().set_relay_open(analyzer_name)
+
+  # Connections with an alternative path move to it
+  checks = relay_reroute_expected(args, test_step, state.get_current(), state.get_next())
+
   affected_talkers = set()
   # Expect all the connections which cross the relay to be lost
-  for c,n in state.get_current().active_connections.iteritems():
-    if not n:
-      continue
-
-    path = graph.find_path(state.get_current(), c.talker.src, c.listener.dst)
-    if path and analyzer_name in path:
-      affected_talkers |= set([c.talker])
-      checks += sequences.analyzer_listener_disconnect_seq(test_step,
-                      c.talker.src, c.talker.src_stream,
-                      c.listener.dst, c.listener.dst_stream)
-      state.get_next().disconnect(c.talker.src, c.talker.src_stream, c.listener.dst, c.listener.dst_stream)
+  for c in get_relay_lost_connections(analyzer_name):
+    affected_talkers |= set([c.talker])
+    sequences.analyzer_listener_disconnect_unregister_errors(c.listener.dst)
+    checks += sequences.analyzer_listener_disconnect_seq(test_step,
+                    c.talker.src, c.talker.src_stream,
+                    c.listener.dst, c.listener.dst_stream)
+    state.get_next().disconnect(c.talker.src, c.talker.src_stream, c.listener.dst, c.listener.dst_stream)
 
   for talker in affected_talkers:
     if not state.get_next().talker_active_count(talker.src, talker.src_stream):
       checks += [Expected(talker.src, "Talker stream #%d off" % talker.src_stream, 30)]
 
-  # Send the command to close the relay '(r)elay (c)lose'
-  args.master.sendLine(analyzer_name, "r o")
-  state.get_next().set_relay_open(analyzer_name)
-
   if test_step.do_checks and checks:
     expected += [AllOf(checks)]
     yield args.master.expect(None)
   else:
     # At least allow time for the relay to actually be closed
-    yield base.sleep(0.1)
+    yield sleep(0.1)
 
 def action_check_connections(args, test_step, expected, params_list):
   """ Check that the current state the controller reads from the endpoints matches
@@ -481,7 +549,7 @@ def action_check_connections(args, test_step, expected, params_list):
 def action_sleep(args, test_step, expected, params_list):
   """ Do nothing for the defined time.
   """
-  yield base.sleep(int(params_list[0]))
+  yield sleep(int(params_list[0]))
 
 def action_continue(args, test_step, expected, params_list):
   """ Do nothing.
@@ -506,3 +574,44 @@ def action_generator(args, test_step, expected, params_list):
     args.master.sendLine(generator_name, "m d")
 
   yield args.master.expect(None)
+
+def get_action_functions():
+  """ Get all the test step commands by name (without the action_ prefix). The module
+      functions are replaced by versions wrapped to record the command as the kind of
+      the expected messages they create themselves, so that direct calls also record it.
+  """
+  functions = {}
+  for (name, fn) in globals().items():
+    if name.startswith('action_') and callable(fn):
+      kind = name[len('action_'):]
+      functions[kind] = globals()[name] = latency.with_kind(kind, fn)
+  return functions
+
+# Built once at import so that dispatching a test step is just a dictionary access
+action_functions = get_action_functions()
+
+def get_action_function(name):
+  try:
+    return action_functions[name]
+  except KeyError:
+    base.testError("Unknown command '%s'" % name, critical=True)
+
+def check_test_config(test_config):
+  """ Check that every command in a test configuration (as read by json.load) has
+      an action function so that errors are reported before any process is started.
+  """
+  unknown = set()
+  to_check = [test_config]
+  while to_check:
+    item = to_check.pop()
+    if isinstance(item, dict):
+      if 'command' in item:
+        name = item['command'].split(' ')[0]
+        if name not in action_functions:
+          unknown.add(name)
+      to_check += item.values()
+    elif isinstance(item, list):
+      to_check += item
+
+  if unknown:
+    base.testError("Unknown command(s) in test: %s" % ', '.join(sorted(unknown)), critical=True)
@@ -1,12 +1,14 @@
 import os
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor
 
 import xmos.test.process as process
 import xmos.test.master as master
 import xmos.test.base as base
 from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
 
+import startup
+
 all_analyzers = {}
 
 def get_all():
@@ -36,21 +38,21 @@ def startAnalyzer(combined_args):
 
   log_info("Starting analyzer %s" % name)
 
-  reactor.spawnProcess(target_process, xrun,
+  startup.spawn_process(target_process, xrun,
       [xrun, '--adapter-id', adapter_id, '--xscope-port', 'localhost:%d' % port, target_bin],
       env=os.environ, path=args.logdir)
 
-  reactor.spawnProcess(analyzer_process, analyzer_bin, [analyzer_bin, '-p', '%d' % port],
+  startup.spawn_process(analyzer_process, analyzer_bin, [analyzer_bin, '-p', '%d' % port],
       env=os.environ, path=args.logdir)
 
-def startAnalyzerWithDelay(rootDir, master, delay, name, adapter_id, analyzer, args):
+def scheduleAnalyzer(rootDir, master, scheduler, name, adapter_id, analyzer, args):
   # Need to ensure that the endpoint and process are created and registered before the
   # master task is started
-  analyzer_process = process.Process(name, master,
+  analyzer_process = startup.ReadyProcess(name, master,
       output_file=os.path.join(args.logdir, name + '_console.log'))
 
   target_name = name + '_target'
-  target_process = process.XrunProcess(target_name, master,
+  target_process = startup.LoggedXrunProcess(target_name, master,
       output_file=os.path.join(args.logdir, target_name + '_console.log'))
 
   if analyzer['type'] == 'audio':
@@ -60,17 +62,19 @@ def startAnalyzerWithDelay(rootDir, master, delay, name, adapter_id, analyzer, a
     target_bin = os.path.join(rootDir, 'sw_ethernet_tap', 'app_avb_tester', 'bin', 'app_avb_tester.xe')
     analyzer_bin = os.path.join(rootDir, 'sw_ethernet_tap', 'host_avb_tester', 'avb_tester')
   else:
-    test_error("%s: unknown type '%s'" % (name, analyzer['type']), critical=True)
+    base.testError("%s: unknown type '%s'" % (name, analyzer['type']), critical=True)
 
-  log_info("Starting %s analyzer %s in %.3f" % (analyzer['type'], name, delay))
-  d = defer.Deferred()
-  reactor.callLater(delay, d.callback, (name, adapter_id, target_bin, analyzer_bin,
+  # The analyzer is ready once the host application has connected to the target
+  log_info("Scheduling %s analyzer %s" % (analyzer['type'], name))
+  scheduler.add(name, analyzer_process, "connected to .*: %d" % analyzer['port'],
+      startAnalyzer, (name, adapter_id, target_bin, analyzer_bin,
        target_process, analyzer_process, analyzer['port'], args))
-  d.addCallback(startAnalyzer)
 
-def start(rootDir, args, master, analyzers, test_config, initial_delay):
+def configure(args, analyzers, test_config):
+  """ Register the analyzers described in the configuration file, applying any
+      type overrides from the test file or command-line.
+  """
   overrides = {}
-  delay = initial_delay
 
   # Read any test file specified types
   for name,new_type in test_config.get('types', {}).iteritems():
@@ -79,27 +83,26 @@ def start(rootDir, args, master, analyzers, test_config, initial_delay):
   # Read any command-line specified types
   for override in args.types:
     if '=' not in override:
-      test_error("Type override should be of the form '<name>=<type>', found '%s'" % override,
+      base.testError("Type override should be of the form '<name>=<type>', found '%s'" % override,
           critical=True)
     name,new_type = override.split('=')
     overrides[name] = new_type
 
   for analyzer in analyzers:
     name = analyzer['name']
-    all_analyzers[name] = analyzer
     if args.user not in analyzer['users']:
-      teset_error("User '%s' not found in config file '%s' for analyzer '%s'" %
+      base.testError("User '%s' not found in config file '%s' for analyzer '%s'" %
           (args.user, args.config, name), critical=True)
 
+    # The configuration is shared by every test, so an override only applies to a copy
     if name in overrides:
-      analyzer['type'] = overrides[name]
-
-    user_config = analyzer['users'][args.user]
-    startAnalyzerWithDelay(rootDir, master, delay, name, user_config['xrun_adapter_id'], analyzer, args)
-
-    delay += 2.0
+      analyzer = dict(analyzer, type=overrides[name])
+    all_analyzers[name] = analyzer
 
-  # Return the delay used so that the next set of processes can be started after these ones
-  # to minimize chances of interference
-  return delay
+def start(rootDir, args, master, analyzers, test_config, scheduler):
+  configure(args, analyzers, test_config)
 
+  for analyzer in analyzers:
+    analyzer = get(analyzer['name'])
+    user_config = analyzer['users'][args.user]
+    scheduleAnalyzer(rootDir, master, scheduler, analyzer['name'], user_config['xrun_adapter_id'], analyzer, args)
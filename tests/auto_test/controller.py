@@ -0,0 +1,113 @@
+""" Parsing of the output of the controllers.
+
+    Output arrives in arbitrary chunks so it is split into lines here, keeping any
+    partial line until the rest of it arrives. Each complete line is then passed
+    through a small state machine which tracks the entity listings printed by the
+    controller and the notifications of entities arriving and departing.
+"""
+import re
+import time
+
+# The header printed by the C controller before its list of entities
+C_LIST_HEADER = re.compile("End Station  \|  Name                  \|  Entity GUID         \|  MAC")
+
+# The summary printed by the python controller before its list of entities
+PYTHON_LIST_HEADER = re.compile("Found (\d+) entities")
+
+# The notifications printed by the C controller when an entity appears or departs
+C_ENTITY_NOTIFICATION = re.compile("NOTIFICATION.*(END_STATION_CONNECTED|END_STATION_RECONNECTED|END_STATION_DISCONNECTED)"
+                                   "\s*,\s*0x([0-9a-fA-F]+)")
+
+# States of the line parser
+IDLE = 'idle'
+LISTING = 'listing'
+
+class ControllerOutputParser(object):
+  """ An incremental parser for the controller output which maintains a table of
+      the entities seen in the most recent listing. The table maps the entity GUID
+      to the time it was last seen. The entities which the controller has been
+      notified are available are kept in the same form.
+  """
+  def __init__(self, controller_type, clock=time.time):
+    self.controller_type = controller_type
+    self.clock = clock
+    self.partial_line = ''
+    self.state = IDLE
+    self.listing_remaining = 0
+    self.listings_completed = 0
+    self.entities = {}
+    self.available = {}
+
+  def data_received(self, data):
+    """ Process a new chunk of output. Only the new data is split into lines.
+    """
+    lines = data.split('\n')
+    lines[0] = self.partial_line + lines[0]
+    self.partial_line = lines.pop()
+
+    for line in lines:
+      self.line_received(line.rstrip('\r'))
+
+  def line_received(self, line):
+    if self.controller_type == 'python':
+      self.python_line_received(line)
+    else:
+      self.c_line_received(line)
+
+  def start_listing(self):
+    self.state = LISTING
+    self.entities.clear()
+
+  def end_listing(self):
+    self.state = IDLE
+    self.listings_completed += 1
+
+  def add_entity(self, guid):
+    self.entities[guid] = self.clock()
+
+  def python_line_received(self, line):
+    m = PYTHON_LIST_HEADER.search(line)
+    if m:
+      self.start_listing()
+      self.listing_remaining = int(m.group(1))
+      if not self.listing_remaining:
+        self.end_listing()
+      return
+
+    # The listing ends once all the entities counted in the summary have been seen.
+    # Any other lines printed among them are skipped.
+    if self.state == LISTING:
+      guid = next((f for f in line.split() if f.startswith('0x')), None)
+      if guid is None:
+        return
+      try:
+        self.add_entity(int(guid, 16))
+      except ValueError:
+        return
+      self.listing_remaining -= 1
+      if not self.listing_remaining:
+        self.end_listing()
+
+  def c_line_received(self, line):
+    m = C_ENTITY_NOTIFICATION.search(line)
+    if m:
+      (notification, guid) = m.groups()
+      if notification == 'END_STATION_DISCONNECTED':
+        self.available.pop(int(guid, 16), None)
+      else:
+        self.available[int(guid, 16)] = self.clock()
+
+    elif line.startswith('C - End Station'):
+      if self.state == LISTING:
+        self.end_listing()
+
+    elif self.state == IDLE:
+      if C_LIST_HEADER.search(line):
+        self.start_listing()
+
+    elif line.startswith('C '):
+      try:
+        guid = line.split('|')[2].strip()
+        self.add_entity(int(guid, 16))
+      except (IndexError, ValueError):
+        pass
@@ -1,8 +1,9 @@
+import hashlib
 import sys
 import time
 import os
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor
 
 import xmos.test.process as process
 import xmos.test.master as master
@@ -10,6 +11,8 @@ import xmos.test.base as base
 from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
 
 import analyzers
+import startup
+import state
 
 all_endpoints = {}
 
@@ -87,23 +90,36 @@ def startXrun(combined_args):
   xrun = base.file_abspath(exe_name)
 
   log_info("Starting %s (%s)" % (name, ' '.join(['--adapter-id', adapter_id, '--xscope', '--xscope-file',  name + '.xmt', bin])))
-  reactor.spawnProcess(process, xrun, [xrun, '--adapter-id', adapter_id, '--xscope', '--xscope-file', name + '.xmt', bin],
+  startup.spawn_process(process, xrun, [xrun, '--adapter-id', adapter_id, '--xscope', '--xscope-file', name + '.xmt', bin],
       env=os.environ, path=args.logdir)
 
-def startXrunWithDelay(rootDir, master, delay, name, adapter_id, args):
+def get_firmware_path(rootDir):
+  return os.path.join(rootDir, 'sw_avb_dc', 'app_daisy_chain', 'bin', 'app_daisy_chain.xe')
+
+def get_firmware_hash(rootDir):
+  """ Get a hash of the endpoint binary so that it is possible to tell whether the
+      running endpoints need to be reloaded. Returns None if there is no binary.
+  """
+  try:
+    with open(get_firmware_path(rootDir), 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+  except IOError:
+    return None
+
+def scheduleXrun(rootDir, master, scheduler, name, adapter_id, args):
   # Need to ensure that the endpoint and process are created and registered before the
   # master task is started
-  ep = process.XrunProcess(name, master,
+  ep = startup.ReadyXrunProcess(name, master,
       output_file=os.path.join(args.logdir, name + '_console.log'))
-  ep_bin = os.path.join(rootDir, 'sw_avb_dc', 'app_daisy_chain', 'bin', 'app_daisy_chain.xe')
+  ep_bin = get_firmware_path(rootDir)
 
-  log_info("Starting %s in %.3f" % (name, delay))
-  d = defer.Deferred()
-  reactor.callLater(delay, d.callback, (name, ep, adapter_id, ep_bin, args))
-  d.addCallback(startXrun)
+  # The endpoint is ready once PTP is running, which is the first thing checked
+  scheduler.add(name, ep, "PTP (Port \d+ )?Role:", startXrun, (name, ep, adapter_id, ep_bin, args))
 
-def start(rootDir, args, master, endpoints, initial_delay):
-  delay = initial_delay
+def configure(args, endpoints):
+  """ Register the endpoints described in the configuration file and connect
+      them up to their analyzers.
+  """
   for ep in endpoints:
     name = ep['name']
     all_endpoints[name] = ep
@@ -113,10 +129,14 @@ def start(rootDir, args, master, endpoints, initial_delay):
           (args.user, args.config, name))
       sys.exit(1)
 
-    user_config = ep['users'][args.user]
-    startXrunWithDelay(rootDir, master, delay, ep['name'], user_config['xrun_adapter_id'], args)
-
-    delay += 2.0
+    # Descriptor values taken from the state must be known to it
+    for dtor in ep.get('descriptors', {}).values():
+      for elements in dtor.values():
+        for element in elements:
+          if element.get('type') == 'state' and element['item'] not in state.state_accessors:
+            log_error("Unknown state item '%s' in descriptors for endpoint '%s'" %
+                (element['item'], name))
+            sys.exit(1)
 
   # Connect up the analyzers to then endpoints
   for ep in endpoints:
@@ -125,7 +145,9 @@ def start(rootDir, args, master, endpoints, initial_delay):
       log_error("Invalid analyzer '%s' for endpoint '%s'" % (analyzer_name, ep['name']))
     ep['analyzer'] = analyzers.get_all()[analyzer_name]
 
-  # Return the delay used so that the next set of processes can be started after these ones
-  # to minimize chances of interference
-  return delay
+def start(rootDir, args, master, endpoints, scheduler):
+  configure(args, endpoints)
 
+  for ep in endpoints:
+    user_config = ep['users'][args.user]
+    scheduleXrun(rootDir, master, scheduler, ep['name'], user_config['xrun_adapter_id'], args)
@@ -0,0 +1,136 @@
+""" A single log of everything that happens during a run.
+
+    Every line of output from every process, every test step and every expected
+    message matched is written as one JSON record per line. Each record has a
+    sequential id and a timestamp from a monotonic clock (or the virtual clock), the
+    first record marking the start of the run. Records are handed to a writer thread
+    so that the reactor never waits for the file to be written.
+
+    Matches refer to the id of the last line received from the process, which is
+    the line that caused the match unless the process sent several lines at once.
+"""
+import ctypes
+import ctypes.util
+import json
+import os
+import Queue
+import threading
+import time
+
+class timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1
+
+def get_clock_gettime():
+  try:
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    return librt.clock_gettime
+  except (OSError, AttributeError):
+    return None
+
+clock_gettime = get_clock_gettime()
+
+def monotonic():
+  """ Seconds from a clock which is not changed when the system time is set, so
+      that the times of a recording can be replayed. Falls back to the system time
+      where there is no monotonic clock.
+  """
+  if clock_gettime is None:
+    return time.time()
+
+  t = timespec()
+  if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno))
+  return t.tv_sec + t.tv_nsec * 1e-9
+
+class EventWriter(threading.Thread):
+  """ Writes records to a file from a queue
+  """
+  def __init__(self, filename):
+    threading.Thread.__init__(self, name='event_writer')
+    self.daemon = True
+    self.queue = Queue.Queue()
+    self.f = open(filename, 'w', 64 * 1024)
+
+  def run(self):
+    while True:
+      record = self.queue.get()
+      if record is None:
+        break
+      self.f.write(json.dumps(record, sort_keys=True))
+      self.f.write('\n')
+    self.f.close()
+
+  def write(self, record):
+    self.queue.put(record)
+
+  def close(self):
+    self.queue.put(None)
+    self.join()
+
+
+clock = monotonic
+writer = None
+next_id = 0
+partial_lines = {}
+last_line_ids = {}
+
+def open_log(filename, clock_fn=monotonic):
+  global clock
+  global writer
+  clock = clock_fn
+  writer = EventWriter(filename)
+  writer.start()
+  add('start')
+
+def close_log():
+  global writer
+  if writer is not None:
+    writer.close()
+    writer = None
+
+def add(event_type, **fields):
+  """ Add a record to the log, returning its id
+  """
+  global next_id
+  if writer is None:
+    return None
+
+  fields['id'] = next_id
+  fields['type'] = event_type
+  fields['time'] = clock()
+  next_id += 1
+  writer.write(fields)
+  return fields['id']
+
+def output(process_name, data):
+  """ Log the output of a process. Only complete lines are logged, any partial line
+      is kept until the rest of it is received.
+  """
+  if writer is None:
+    return
+
+  lines = data.split('\n')
+  lines[0] = partial_lines.get(process_name, '') + lines[0]
+  partial_lines[process_name] = lines.pop()
+
+  for line in lines:
+    last_line_ids[process_name] = add('line', process=process_name, line=line.rstrip('\r'))
+
+def test_start(test_name):
+  return add('test_start', test=test_name)
+
+def test_end(test_name):
+  return add('test_end', test=test_name)
+
+def step(test_name, step_num, command):
+  add('step', test=test_name, step=step_num, command=command)
+
+def check(test_name, check_num):
+  add('check', test=test_name, check=check_num)
+
+def matched(expected_id, kind, process_name, pattern):
+  add('match', expected=expected_id, kind=kind, process=process_name, pattern=pattern,
+      line_id=last_line_ids.get(process_name))
@@ -1,87 +1,181 @@
+import collections
+
 import xmos.test.base as base
 import xmos.test.xmos_logging as xmos_logging
 from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
 
 import endpoints
-import avb_1722
 
 """ The physical connections as defined in the test configuration file. These
     are used to determine the paths between two endpoints.
 """
 physical_connections = {}
 
+""" The routes between nodes. There is one table per set of open relays and each
+    table maps start -> end -> path. Tables are only built when a new relay
+    configuration is seen.
+"""
+route_tables = {}
+
+""" The connected components of the physical connections. There is one labelling
+    per set of open relays, mapping each node to the set of endpoints that can be
+    reached from it.
+"""
+component_tables = {}
+
 def set_connections(connections):
   global physical_connections
   physical_connections = connections
-
-def _find_path(state, start, end, path=[]):
-  """ Recursive function to build up the path between the specified start and end point
+  route_tables.clear()
+  component_tables.clear()
+
+def _build_routes(open_relays, start):
+  """ Find the shortest path from the start node to every node that can be reached
+      from it. The search is breadth-first and visits the connections of each node in
+      name order so that the same path is always chosen when a topology contains rings
+      or redundant links. An open relay can be reached but cannot be routed through.
   """
-  path = path + [start]
-  if start == end:
-    return path
+  routes = { start : [start] }
+  queue = collections.deque([start])
+  while queue:
+    node = queue.popleft()
+    if node in open_relays or not physical_connections.has_key(node):
+      continue
+
+    for next_node in sorted(physical_connections[node]):
+      if next_node not in routes:
+        routes[next_node] = routes[node] + [next_node]
+        queue.append(next_node)
+
+  return routes
 
-  if not physical_connections.has_key(start):
-    return None
+def _find_path(state, start, end):
+  """ Look up the path between the start and end point in the route table for the
+      current set of open relays
+  """
+  open_relays = state.get_open_relays()
+  routes = route_tables.get(open_relays)
+  if routes is None:
+    routes = route_tables[open_relays] = {}
 
-  if state.is_relay_open(start):
-    return None
+  start_routes = routes.get(start)
+  if start_routes is None:
+    start_routes = routes[start] = _build_routes(open_relays, start)
 
-  for node in physical_connections[start]:
-    if node not in path:
-      newpath = _find_path(state, node, end, path)
-      if newpath:
-        return newpath
-  return None
+  return start_routes.get(end)
 
 def find_path(state, start, end, path=[]):
-  """ A front-end for debug purposes
+  """ A front-end for debug purposes. The path returned is shared with the route
+      table and must not be modified.
   """
   path = _find_path(state, start, end)
   log_debug("find_path %s -> %s : %s" % (start, end, path))
   return path
 
-def _get_loops(state, node, path_so_far, loops):
-  """ Recursive function that looks through connections to search for loops.
-      Any loop that is found is added to the loops list.
+class LoopTracker(object):
+  """ Track the loops in the talker -> listener connections between nodes. The loops
+      are the strongly connected components of the connection graph and are updated
+      as each connection is added or removed rather than searched for on demand.
   """
-  for c,n in state.active_connections.iteritems():
-    if not n or (node != c.talker.src):
-      continue
-
-    dest = c.listener.dst
-    if dest in path_so_far:
-      # Only add this as a loop if the destination is the same as the start node.
-      # Otherwise this is a path that has joined a loop.
-      if dest == path_so_far[0]:
-        loops += [path_so_far + [dest]]
+  def __init__(self):
+    self.successors = {}
+    self.predecessors = {}
+    self.loop_of = {}
+
+  def _reachable(self, start, edges, within=None):
+    """ Find all the nodes that can be reached from the start node
+    """
+    reached = set([start])
+    stack = [start]
+    while stack:
+      node = stack.pop()
+      for next_node in edges.get(node, {}):
+        if next_node not in reached and (within is None or next_node in within):
+          reached.add(next_node)
+          stack.append(next_node)
+    return reached
+
+  def _set_loop(self, nodes):
+    loop = frozenset(nodes)
+    for node in loop:
+      self.loop_of[node] = loop
+
+  def add_connection(self, src, dst):
+    count = self.successors.setdefault(src, {}).get(dst, 0)
+    self.successors[src][dst] = count + 1
+    self.predecessors.setdefault(dst, {})[src] = count + 1
+    if count:
+      return
+
+    # A new edge creates (or grows) a loop if the src can be reached from the dst.
+    # The loop then consists of all nodes on a path from the dst back to the src.
+    downstream = self._reachable(dst, self.successors)
+    if src in downstream:
+      upstream = self._reachable(src, self.predecessors)
+      self._set_loop(downstream & upstream)
+
+  def remove_connection(self, src, dst):
+    count = self.successors[src][dst] - 1
+    if count:
+      self.successors[src][dst] = count
+      self.predecessors[dst][src] = count
+      return
+
+    del self.successors[src][dst]
+    del self.predecessors[dst][src]
+
+    loop = self.loop_of.get(src)
+    if loop is None or dst not in loop:
+      return
+
+    # Removing an edge within a loop can only split that loop, so only its members
+    # need to be regrouped
+    for node in loop:
+      del self.loop_of[node]
+
+    remaining = set(loop)
+    while remaining:
+      node = remaining.pop()
+      downstream = self._reachable(node, self.successors, loop)
+      upstream = self._reachable(node, self.predecessors, loop)
+      component = downstream & upstream
+      remaining -= component
+      if len(component) > 1:
+        self._set_loop(component)
+
+  def copy(self):
+    tracker = LoopTracker()
+    tracker.successors = dict((node, dict(edges)) for node,edges in self.successors.iteritems())
+    tracker.predecessors = dict((node, dict(edges)) for node,edges in self.predecessors.iteritems())
+    tracker.loop_of = dict(self.loop_of)
+    return tracker
+
+  def get_loops(self):
+    return set(self.loop_of.values())
+
+  def get_loop(self, node):
+    return self.loop_of.get(node)
 
-    else:
-      _get_loops(state, dest, path_so_far + [dest], loops)
 
 def get_loops(state):
-  """ Find all the loops in the current set of connections.
+  """ Get all the loops in the current set of connections. Each loop is a list
+      of the nodes in it, sorted by name.
   """
-  loops = []
-
-  for t,n in state.active_talkers.iteritems():
-    # If the endpoint is not active or already in a loop then ignore it
-    if not n or any(t.src in loop for loop in loops):
-      continue
-
-    _get_loops(state, t.src, [t.src], loops)
-
+  loops = sorted(sorted(loop) for loop in state.loops.get_loops())
   log_debug("get_loops got %s" % loops)
   return loops
 
-def is_in_loop(state, node):
-  in_loop = False
-  loops = get_loops(state)
-  for loop in loops:
-    if node in loop:
-      in_loop = True
-      break
+def get_loop_master(state, loop):
+  """ The clock source master of a loop is the first node in it that is already
+      a clock source master. If there is none then the first node is elected.
+  """
+  for node in loop:
+    if state.is_clock_source_master(node):
+      return node
+  return loop[0]
 
+def is_in_loop(state, node):
+  in_loop = state.loops.get_loop(node) is not None
   log_debug("is_in_loop %s = %d" % (node, in_loop))
   return in_loop
 
@@ -103,47 +197,35 @@ def get_forward_port(state, src, dst, node):
   log_debug("get_forward_port %s in %s -> %s: %s" % (node, src, dst, port))
   return port
 
-def port_is_egress_in_path(state, connection, ep_name, port):
-  """ Determine whether a port is an egress port in a given path
+def get_forwarding_nodes(state, talker):
+  """ Get the endpoints which forward a talker stream on to at least one of its listeners
   """
-  path = find_path(state, connection.talker.src, connection.listener.dst)
-  # As long as the endpoint is in the path before the end
-  if path and ep_name in path and ep_name != connection.listener.dst:
-    # Determine wether this port is the egress port for the path found
-    # that means the node after the endpoint. 
-    index = path.index(ep_name)
-
-    # The port ID is the last character of the port name
-    egress_port = int(path[index + 1][-1])
-    if port == egress_port:
-      return True
+  return set(state.get_forwarding_nodes(talker.src, talker.src_stream))
 
-  return False
+def get_rerouted_talkers(before, after):
+  """ Find the talker streams which have a connection that takes a different path
+      in the after state than it did in the before state.
+  """
+  talkers = set()
+  for c,path in after.connection_paths.iteritems():
+    if before.connection_paths.get(c, path) != path:
+      talkers.add(c.talker)
+  return talkers
+
+def get_changed_reservations(before, after):
+  """ Find the (node, port) pairs whose reserved bandwidth differs between two states
+  """
+  changed = []
+  for key in sorted(set(before.port_reservations) | set(after.port_reservations)):
+    if before.get_port_bandwidth(*key) != after.get_port_bandwidth(*key):
+      changed.append(key)
+  return changed
 
 def calculate_expected_bandwidth(state, ep, port):
-  ep_name = ep['name']
-  bandwidth = 0
-  for c,n in state.active_connections.iteritems():
-    if not n:
-      continue
-
-    if port_is_egress_in_path(state, c, ep_name, port):
-      # A bridge must reserve an extra byte per packet
-      is_bridge = ep_name != c.talker.src
-      bandwidth += avb_1722.calculate_stream_bandwidth(c.talker, is_bridge)
-
-  return bandwidth
+  return state.get_port_bandwidth(ep['name'], port)
 
 def port_will_see_bandwidth_change(state, src, src_stream, ep_name, port, command):
-  num_active_streams = 0
-  
-  # Look at all connections of this src stream
-  for c,n in state.active_connections.iteritems():
-    if not n or c.talker.src != src or c.talker.src_stream != src_stream:
-      continue
-
-    if port_is_egress_in_path(state, c, ep_name, port):
-      num_active_streams += 1
+  num_active_streams = state.get_port_stream_count(ep_name, port, src, src_stream)
 
   log_debug("port_will_see_bandwidth_change found %d active streams for %s:%s" % (
         num_active_streams, ep_name, port))
@@ -169,25 +251,11 @@ def node_will_see_stream_enable(state, src, src_stream, dst, dst_stream, node):
     log_debug("No, connection will not happen")
     return False
 
-  # Look at all connections of this src stream
-  for c,n in state.active_connections.iteritems():
-    if not n or c.talker.src != src or c.talker.src_stream != src_stream:
-      continue
-
-    nodes = find_path(state, src, c.listener.dst)
-    log_debug("What about path %s?" % nodes)
-      
-    # Look for all nodes past this one in the path. If one of them is connected to
-    # this stream then this node won't see enable, otherwise it should expect to
-    past_node = False
-    for n in nodes:
-      if past_node:
-        if state.connected(src, src_stream, n):
-          log_debug("No forwarding, node %s is connected beyond %s?" % (n, node))
-          return False
-
-      elif n == node:
-        past_node = True
+  # If the node is already in the forwarding tree of this stream then it won't see
+  # enable, otherwise it should expect to
+  if state.get_forwarding_count(src, src_stream, node):
+    log_debug("No forwarding, node %s is already forwarding %s:%s" % (node, src, src_stream))
+    return False
 
   return True
 
@@ -200,40 +268,69 @@ def node_will_see_stream_disable(state, src, src_stream, dst, dst_stream, node):
     log_debug("No, stream not connected")
     return False
 
-  # Look at all connections of this src stream
-  for c,n in state.active_connections.iteritems():
-    if not n:
-      continue
+  # If the node forwards this stream for any other connection then it won't see
+  # disable, otherwise it should expect to
+  if state.get_forwarding_count(src, src_stream, node) > 1:
+    log_debug("No forwarding, node %s is forwarding %s:%s to others" % (node, src, src_stream))
+    return False
+
+  return True
 
-    if c.talker.src != src or c.talker.src_stream != src_stream:
+def get_forwarding_changes(state, src, src_stream, dst, dst_stream, command):
+  """ Find the nodes on the path between src/dst which will see the stream forwarding
+      enabled (on connect) or disabled (on disconnect). This is the difference the
+      connection makes to the forwarding tree of the stream.
+  """
+  nodes = endpoints.get_path_endpoints(find_path(state, src, dst))
+  if command == 'connect':
+    changes = [node for node in nodes
+               if node_will_see_stream_enable(state, src, src_stream, dst, dst_stream, node)]
+  else:
+    changes = [node for node in nodes
+               if node_will_see_stream_disable(state, src, src_stream, dst, dst_stream, node)]
+
+  log_debug("get_forwarding_changes %s %s:%s -> %s:%s: %s" % (
+        command, src, src_stream, dst, dst_stream, changes))
+  return changes
+
+def _label_components(open_relays):
+  """ Flood fill the physical connections to find which nodes are connected. An open
+      relay can be reached but nothing can be reached through it. The connections
+      are bidirectional, so every node in a component can reach the same endpoints.
+  """
+  reachable_from = {}
+  for start in sorted(physical_connections):
+    if start in reachable_from or start in open_relays:
       continue
 
-    nodes = find_path(state, src, c.listener.dst)
-    log_debug("What about path %s?" % nodes)
-      
-    # Look for all nodes past this one in the path. If one of them is connected to
-    # this stream then this node won't see disable, otherwise it should expect to
-    past_node = False
-    for n in nodes:
-      if n == dst:
-        # Ignore the current connection
+    component = set([start])
+    stack = [start]
+    while stack:
+      node = stack.pop()
+      if node in open_relays:
         continue
+      for next_node in physical_connections.get(node, []):
+        if next_node not in component:
+          component.add(next_node)
+          stack.append(next_node)
 
-      if past_node:
-        if state.connected(src, src_stream, n):
-          log_debug("No forwarding, node %s is connected beyond %s?" % (n, node))
-          return False
+    reachable = frozenset(node for node in component if endpoints.get(node))
+    for node in component:
+      if node not in open_relays:
+        reachable_from[node] = reachable
 
-      elif n == node:
-        past_node = True
-
-  return True
+  return reachable_from
 
 def get_endpoints_connected_to(state, node):
-  connected = set()
-  for endpoint in endpoints.get_all():
-    if find_path(state, node, endpoint):
-      connected |= set([endpoint])
+  open_relays = state.get_open_relays()
+  reachable_from = component_tables.get(open_relays)
+  if reachable_from is None:
+    reachable_from = component_tables[open_relays] = _label_components(open_relays)
+
+  connected = reachable_from.get(node)
+  if connected is None:
+    # An isolated node or an open relay can only reach itself
+    connected = frozenset([node]) if endpoints.get(node) else frozenset()
+
   log_debug("get_endpoints_connected_to %s: %s" % (node, connected))
   return connected
-
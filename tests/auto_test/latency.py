@@ -0,0 +1,108 @@
+""" Measure the latency from the commands of a test step being sent to each of the
+    expected messages being seen.
+
+    Each expected message records the step that was running when it was created and
+    the kind of sequence it belongs to (the name of the sequence builder). When it is
+    matched the time since the step started is recorded. At the end of a run all the
+    latencies are written out along with a histogram for each kind of sequence.
+"""
+import json
+import time
+import types
+
+# Upper bounds of the histogram buckets in milliseconds
+HISTOGRAM_BUCKETS = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000]
+
+clock = time.time
+current_step = None
+records = []
+
+# The kind of sequence currently being built, recorded by each expected message
+current_kind = None
+
+def set_clock(clock_fn):
+  global clock
+  clock = clock_fn
+
+def run_with_kind(kind, fn, *args):
+  global current_kind
+  previous_kind = current_kind
+  current_kind = kind
+  try:
+    return fn(*args)
+  finally:
+    current_kind = previous_kind
+
+def resume_with_kind(kind, steps):
+  while True:
+    try:
+      y = run_with_kind(kind, next, steps)
+    except StopIteration:
+      return
+    yield y
+
+def with_kind(kind, builder):
+  """ Wrap a sequence builder or an action so that the expected messages it creates
+      record the kind of sequence they are part of. Actions are generators, so the
+      kind is set each time one is resumed rather than just when it is called.
+  """
+  def build(*args):
+    result = run_with_kind(kind, builder, *args)
+    if isinstance(result, types.GeneratorType):
+      return resume_with_kind(kind, result)
+    return result
+  build.__name__ = builder.__name__
+  build.__doc__ = builder.__doc__
+  return build
+
+def start_step(test_name, step_num, command):
+  """ Called just before the commands for a test step are sent
+  """
+  global current_step
+  current_step = { 'test' : test_name, 'step' : step_num, 'command' : command, 'sent' : clock() }
+
+def matched(kind, step, process, pattern):
+  """ Called when an expected message has been seen
+  """
+  if kind is None or step is None:
+    return
+
+  now = clock()
+  records.append({ 'test' : step['test'], 'step' : step['step'], 'command' : step['command'],
+                   'kind' : kind, 'process' : process, 'pattern' : pattern,
+                   'sent' : step['sent'], 'matched' : now,
+                   'latency_ms' : (now - step['sent']) * 1000 })
+
+def get_histogram(latencies):
+  histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+  for latency in latencies:
+    bucket = 0
+    while bucket < len(HISTOGRAM_BUCKETS) and latency > HISTOGRAM_BUCKETS[bucket]:
+      bucket += 1
+    histogram[bucket] += 1
+  return histogram
+
+def get_summary():
+  """ Get the statistics of the latencies of each kind of sequence
+  """
+  by_kind = {}
+  for record in records:
+    by_kind.setdefault(record['kind'], []).append(record['latency_ms'])
+
+  summary = {}
+  for kind,latencies in by_kind.iteritems():
+    latencies.sort()
+    summary[kind] = {
+      'count' : len(latencies),
+      'min_ms' : latencies[0],
+      'median_ms' : latencies[len(latencies) / 2],
+      'max_ms' : latencies[-1],
+      'histogram' : get_histogram(latencies),
+    }
+  return summary
+
+def write(filename):
+  with open(filename, 'w') as f:
+    json.dump({ 'buckets_ms' : HISTOGRAM_BUCKETS,
+                'kinds' : get_summary(),
+                'records' : records }, f, indent=2, sort_keys=True)
@@ -0,0 +1,114 @@
+""" Replay of a recorded run.
+
+    The event log of a past run is read and each line of output is given to the
+    process of the same name at the time it was originally seen, relative to the
+    start of the run. Nothing is launched and anything sent to the processes is
+    discarded, so the expectations built by the current harness are checked against
+    exactly what the devices did during the recording.
+"""
+import json
+import os
+import sys
+
+from twisted.internet import reactor, error
+from twisted.python import failure
+
+from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
+
+class ReplayTransport(object):
+  """ Stands in for the transport of a launched process
+  """
+  pid = None
+
+  def __init__(self, process_protocol):
+    self.process_protocol = process_protocol
+    self.ended = False
+
+  def write(self, data):
+    log_debug("Replay: not sending '%s' to %s" % (data.strip(), self.process_protocol.name))
+
+  def writeSequence(self, seq):
+    for data in seq:
+      self.write(data)
+
+  def closeStdin(self):
+    pass
+
+  def loseConnection(self):
+    pass
+
+  def signalProcess(self, signal):
+    if self.ended:
+      return
+    self.ended = True
+    reason = failure.Failure(error.ProcessTerminated(signal=signal))
+    reactor.callLater(0, self.process_protocol.processEnded, reason)
+
+def load_lines(run_dir):
+  """ Read the lines of output from the event log of a run. Returns them grouped by
+      process as lists of (time from the start of the run, line).
+  """
+  filename = os.path.join(run_dir, 'events.jsonl')
+  if not os.path.exists(filename):
+    log_error("No event log '%s' to replay" % filename)
+    sys.exit(1)
+
+  lines = {}
+  start_time = None
+  with open(filename) as f:
+    for record_line in f:
+      record = json.loads(record_line)
+      if start_time is None:
+        start_time = record['time']
+
+      if record['type'] == 'line':
+        line = record['line'].encode('utf-8')
+        lines.setdefault(record['process'], []).append((record['time'] - start_time, line))
+  return lines
+
+class Replayer(object):
+  """ Launches processes by connecting them to the recording rather than running them
+  """
+  def __init__(self, run_dir):
+    self.run_dir = run_dir
+    self.lines = load_lines(run_dir)
+    self.start_time = reactor.seconds()
+    self.lines_replayed = 0
+    self.processes_replayed = []
+
+  def spawn(self, process_protocol, executable, args=(), env=None, path=None, **kwargs):
+    """ Used in place of reactor.spawnProcess
+    """
+    name = process_protocol.name
+    transport = ReplayTransport(process_protocol)
+    process_protocol.makeConnection(transport)
+
+    lines = self.lines.pop(name, [])
+    if not lines:
+      log_warning("Replay: no recorded output for %s" % name)
+      return transport
+
+    self.processes_replayed.append(name)
+    self.schedule_line(process_protocol, lines, 0)
+    return transport
+
+  def schedule_line(self, process_protocol, lines, index):
+    # Only the next line of each process is scheduled to keep the number of timers small
+    (offset, line) = lines[index]
+    delay = max(0, offset - (reactor.seconds() - self.start_time))
+    reactor.callLater(delay, self.replay_line, process_protocol, lines, index)
+
+  def replay_line(self, process_protocol, lines, index):
+    (offset, line) = lines[index]
+    process_protocol.outReceived(line + '\n')
+    self.lines_replayed += 1
+
+    if index + 1 < len(lines):
+      self.schedule_line(process_protocol, lines, index + 1)
+
+  def report(self):
+    log_info("Replayed %d lines from %d processes of %s in %.3f" % (self.lines_replayed,
+        len(self.processes_replayed), self.run_dir, reactor.seconds() - self.start_time))
+
+    for name in sorted(self.lines.keys()):
+      log_warning("Replay: recorded output for %s was not used" % name)
@@ -3,13 +3,20 @@
 import datetime
 import dateutil.relativedelta
 import errno
+import hashlib
+import json
 import os
 import psutil
+import Queue
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
+import traceback
+
+from path_setup import rootDir
 
 test_folders = {
   os.path.join('configs', 'basics') : [1],
@@ -20,6 +27,35 @@ test_folders = {
   os.path.join('configs', 'random_4') : range(1,4),
 }
 
+# When set all the tests in a folder are run in one session, keeping the devices running
+warm = False
+
+# When set the tests are run against the model by simulate.py rather than on hardware
+simulate = False
+
+# The file used to record how long each test takes so that the longest can be run first
+durations_file = 'durations.json'
+durations = {}
+durations_lock = threading.Lock()
+
+# The jobs which failed with an unexpected error while running in parallel
+failed_jobs = []
+
+# When set tests are run even if they have passed before with exactly the same inputs
+force = False
+
+# The endpoint firmware, as loaded by endpoints.py
+firmware_path = os.path.join(rootDir, 'sw_avb_dc', 'app_daisy_chain', 'bin', 'app_daisy_chain.xe')
+
+# Hash of all the source of the test harness, set when starting
+harness_hash = None
+
+# The test framework, which decides whether the expected output was seen
+framework_dir = os.path.join(rootDir, 'test_framework')
+
+# Hash of all the source of the test framework, set when starting
+framework_hash = None
+
 def mkdir_p(path):
   try:
     os.makedirs(path)
@@ -51,78 +87,359 @@ def print_run_time(start, end):
     attr_to_string(rd, 'minutes'),
     attr_to_string(rd, 'seconds'))
 
-def kill_all(process_name):
+def get_cwd(proc):
+  try:
+    if callable(getattr(proc, 'cwd', None)):
+      return proc.cwd()
+    return proc.getcwd()
+  except (psutil.AccessDenied, psutil.NoSuchProcess):
+    return None
+
+def kill_all(process_name, logdir=None):
+  """ Kill any processes left over from a test. When the log directory is given only
+      the processes started in it (by the same rig) are killed.
+  """
   found = False
   for proc in psutil.process_iter():
     if proc.name == process_name and proc.pid not in active_pids:
+      if logdir is not None and get_cwd(proc) != os.path.abspath(logdir):
+        continue
       found = True
       print "Killing %s" % process_name
       proc.kill()
   return found
 
-def run_test(folder, test, seed):
+def get_logdir(folder, name, seed, rig=None):
+  """ Get a log directory for a new run of a test. Each rig has its own directories.
+  """
+  seed_dir = os.path.join(folder, name, 'seed_%d' % seed)
+  if rig is not None:
+    seed_dir = os.path.join(seed_dir, rig)
+
+  run = 1
   while True:
-    test_name = test[:-len('.json')]
-    run = 1
-    while True:
-      logdir = os.path.join(folder, test_name, 'seed_%d' % seed, 'run_%d' % run)
-      if not os.path.exists(logdir):
-        break
-      run += 1
+    logdir = os.path.join(seed_dir, 'run_%d' % run)
+    if not os.path.exists(logdir):
+      return (logdir, run)
+    run += 1
+
+def check_summary(logdir):
+  """ Count the errors in a summary log and determine whether the run needs repeating
+  """
+  errors = 0
+  needs_rerun = False
+  with open(os.path.join(logdir, 'summary.log')) as f:
+    for line in f.readlines():
+      if re.match('^ERROR', line):
+        errors += 1
+      if re.match('^ERROR:.*xrun: The selected adapter is not connected', line):
+        print "XTAG gone AWOL, giving up"
+        sys.exit(1)
+      if re.match('^ERROR:.*xrun:', line):
+        needs_rerun = True
+  return (errors, needs_rerun)
 
-    print "---- Running %s - seed %s run %d ----" % (os.path.join(folder, test_name), seed, run)
-    os.makedirs(logdir)
+def run_logged(logdir, tests, rig=None):
+  """ Run test.py on one or more tests, returning the number of errors and whether
+      it needs to be re-run
+  """
+  mkdir_p(logdir)
+
+  user = ''
+  if rig is not None:
+    user = '--user %s' % rig
 
-    t_start = time.time()
+  t_start = time.time()
+  if simulate:
+    status = os.system("python simulate.py --config four.json %s --output %s/checks.log %s > %s/test.output 2>&1" %
+        (user, logdir, ' '.join(tests), logdir))
+    errors = 1 if status else 0
+    needs_rerun = False
+  else:
     # This was done using subprocess.call, but that fails to work with the
     # tests using the Twisted framework
-    os.system("python test.py --config four.json --logdir %s --summaryfile %s/summary.log --test %s  > %s/test.output 2>&1" %
-        (logdir, logdir, os.path.join(folder, test), logdir))
-    t_end = time.time()
+    os.system("python test.py --config four.json %s --logdir %s --summaryfile %s/summary.log --test %s  > %s/test.output 2>&1" %
+        (user, logdir, logdir, ' '.join(tests), logdir))
+    (errors, needs_rerun) = check_summary(logdir)
+  t_end = time.time()
 
-    errors = 0
-    needs_rerun = False
-    with open(os.path.join(logdir, 'summary.log')) as f:
-      for line in f.readlines():
-        if re.match('^ERROR', line):
-          errors += 1
-        if re.match('^ERROR:.*xrun: The selected adapter is not connected', line):
-          print "XTAG gone AWOL, giving up"
-          sys.exit(1)
-        if re.match('^ERROR:.*xrun:', line):
-          needs_rerun = True
-
-    print_run_time(t_start, t_end)
-    if errors == 0:
-        print "PASSED"
-    else:
-        print "ERROR: found %d errors" % errors
+  print_run_time(t_start, t_end)
+  if errors == 0:
+      print "PASSED"
+  else:
+      print "ERROR: found %d errors" % errors
 
+  if not simulate:
     # Give the xrun processes time to die off
     time.sleep(5)
 
     # Kill off any remaining processes if they exist
     found = True
     while found:
-      found = kill_all('xgdb')
+      found = kill_all('xgdb', logdir if rig is not None else None)
       if found:
         time.sleep(2)
 
+  return (errors, needs_rerun, t_end - t_start)
+
+def get_file_hash(path):
+  try:
+    with open(path, 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+  except IOError:
+    return None
+
+def get_harness_hash():
+  """ A hash of all the python source of the test harness
+  """
+  h = hashlib.sha1()
+  for source in sorted(x for x in os.listdir('.') if x.endswith('.py')):
+    h.update(source)
+    h.update(get_file_hash(source))
+  return h.hexdigest()
+
+def get_framework_hash():
+  """ A hash of all the python source of the test framework
+  """
+  h = hashlib.sha1()
+  for (dirpath, dirnames, filenames) in os.walk(framework_dir):
+    dirnames.sort()
+    for source in sorted(x for x in filenames if x.endswith('.py')):
+      path = os.path.join(dirpath, source)
+      h.update(os.path.relpath(path, framework_dir))
+      h.update(get_file_hash(path))
+  return h.hexdigest()
+
+def get_result_key(folder, test, seed):
+  """ The key for the result of a run. It changes whenever anything which can affect
+      the result of the test changes.
+  """
+  h = hashlib.sha1()
+  for part in [get_file_hash(os.path.join(folder, test)), get_file_hash('four.json'), seed,
+               harness_hash, framework_hash, get_file_hash(firmware_path), simulate]:
+    h.update(str(part))
+  return h.hexdigest()
+
+def get_results_file(folder, test, seed):
+  """ Results are kept alongside the runs of each seed of a test
+  """
+  return os.path.join(folder, test[:-len('.json')], 'seed_%d' % seed, 'results.json')
+
+def load_results(folder, test, seed):
+  try:
+    with open(get_results_file(folder, test, seed)) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+def has_passed(folder, test, seed):
+  """ Determine whether a test has already passed with the same inputs
+  """
+  if force:
+    return False
+
+  result = load_results(folder, test, seed).get(get_result_key(folder, test, seed))
+  return result is not None and result['passed']
+
+def record_result(folder, test, seed, logdir, errors, events=None):
+  """ Record the result of a test. When it was run in a session the range of ids of
+      its records in the event log of the session is given by events.
+  """
+  results = load_results(folder, test, seed)
+  results[get_result_key(folder, test, seed)] = {
+    'passed' : errors == 0,
+    'logdir' : logdir,
+    'events' : events,
+    'time' : time.strftime("%Y_%m_%d_%H_%M_%S"),
+  }
+  mkdir_p(os.path.dirname(get_results_file(folder, test, seed)))
+  with open(get_results_file(folder, test, seed), 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+
+def run_test(folder, test, seed, rig=None):
+  if has_passed(folder, test, seed):
+    print "---- Skipping %s - seed %s already passed ----" % (os.path.join(folder, test), seed)
+    return
+
+  while True:
+    test_name = test[:-len('.json')]
+    (logdir, run) = get_logdir(folder, test_name, seed, rig)
+
+    print "---- Running %s - seed %s run %d%s ----" % (os.path.join(folder, test_name), seed, run, rig_string(rig))
+    (errors, needs_rerun, duration) = run_logged(logdir, [os.path.join(folder, test)], rig)
+
     if needs_rerun:
       print "Found xrun error, re-running test"
     else:
+      record_duration(folder, test, duration)
+      record_result(folder, test, seed, logdir, errors)
       break
 
-def run_folder(folder):
-  seeds = test_folders.get(folder, [1])
-  for seed in seeds:
-    tests = [x for x in os.listdir(folder) if re.match('.*\.json$', x)]
-    tests.sort()
+def run_session(folder, tests, seed, rig=None):
+  """ Run a set of tests in as few sessions of test.py as possible so that the devices
+      are kept running between tests. A session ends early if the firmware changes or
+      a test needs different devices, in which case a new session runs the rest.
+  """
+  for test in tests:
+    if has_passed(folder, test, seed):
+      print "---- Skipping %s - seed %s already passed ----" % (os.path.join(folder, test), seed)
+
+  remaining = [os.path.join(folder, test) for test in tests if not has_passed(folder, test, seed)]
+  while remaining:
+    (logdir, run) = get_logdir(folder, 'session', seed, rig)
+
+    print "---- Running session of %d tests in %s - seed %s run %d%s ----" % (
+        len(remaining), folder, seed, run, rig_string(rig))
+    (errors, needs_rerun, duration) = run_logged(logdir, remaining, rig)
+
+    if needs_rerun:
+      print "Found xrun error, re-running session"
+      continue
+
+    if simulate:
+      # The simulator always runs all of the tests
+      session = { 'completed' : remaining, 'remaining' : [], 'finished' : True }
+    else:
+      try:
+        with open(os.path.join(logdir, 'session.json')) as f:
+          session = json.load(f)
+      except (IOError, ValueError):
+        # The session stopped before completing any test
+        session = { 'completed' : [], 'remaining' : remaining, 'finished' : False }
+
+    # Errors cannot be attributed to one test of a session so the tests only pass
+    # when the whole session does. The time taken is shared between them.
+    completed = session['completed']
+    for test in completed:
+      record_duration(folder, os.path.basename(test), duration / len(completed))
+      record_result(folder, os.path.basename(test), seed, logdir, errors,
+          session.get('events', {}).get(test))
+
+    remaining = session['remaining']
+    if remaining and (not session['finished'] or not completed):
+      # The session stopped part way through a test. That test fails and a new
+      # session runs the rest.
+      failed = remaining.pop(0)
+      print "ERROR: session stopped during %s" % failed
+      record_result(folder, os.path.basename(failed), seed, logdir, max(errors, 1))
+
+def rig_string(rig):
+  if rig is None:
+    return ''
+  return ' on %s' % rig
 
-    top_dir = os.getcwd()
+def load_durations():
+  if os.path.exists(durations_file):
+    with open(durations_file) as f:
+      durations.update(json.load(f))
 
+def save_durations():
+  with durations_lock:
+    with open(durations_file, 'w') as f:
+      json.dump(durations, f, indent=2, sort_keys=True)
+
+def record_duration(folder, test, duration):
+  if simulate:
+    return
+
+  with durations_lock:
+    durations[os.path.join(folder, test)] = duration
+
+def get_jobs(folders):
+  """ Get the list of jobs to run. Each job is a (folder, tests, seed) tuple. When
+      running warm the tests of a folder are all run in one job.
+  """
+  jobs = []
+  for folder in sorted(folders):
+    for seed in test_folders.get(folder, [1]):
+      tests = [x for x in os.listdir(folder) if re.match('.*\.json$', x)]
+      tests.sort()
+
+      if warm:
+        jobs.append((folder, tests, seed))
+      else:
+        jobs += [(folder, [test], seed) for test in tests]
+  return jobs
+
+def estimate_duration(job):
+  """ Estimate how long a job will take from previous runs. Tests which have not been
+      run before are assumed to take as long as the longest known test.
+  """
+  (folder, tests, seed) = job
+  longest = max(durations.values()) if durations else 0
+  return sum(durations.get(os.path.join(folder, test), longest) for test in tests)
+
+def run_job(job, rig):
+  (folder, tests, seed) = job
+  if warm:
+    run_session(folder, tests, seed, rig)
+  else:
     for test in tests:
-      run_test(folder, test, seed)
+      run_test(folder, test, seed, rig)
+
+def rig_worker(rig, jobs):
+  """ Keep taking the longest job remaining until there are none left
+  """
+  while True:
+    try:
+      job = jobs.get_nowait()
+    except Queue.Empty:
+      return
+
+    try:
+      run_job(job, rig)
+    except SystemExit:
+      print "ERROR: rig %s has failed, returning %s to the queue" % (rig, job[0])
+      jobs.put(job)
+      return
+    except Exception:
+      # Any other failure is not the fault of the rig, so it carries on with the
+      # next job. The job is not retried as it would most likely fail again.
+      print "ERROR: %s seed %s failed on rig %s" % (job[0], job[2], rig)
+      traceback.print_exc()
+      failed_jobs.append(job)
+
+def run_parallel(folders, rigs):
+  """ Run the tests of the folders across all the rigs at once. Tests are handed out
+      longest first so that the rigs all finish at roughly the same time.
+  """
+  jobs = get_jobs(folders)
+  jobs.sort(key=estimate_duration, reverse=True)
+
+  job_queue = Queue.Queue()
+  for job in jobs:
+    job_queue.put(job)
+
+  print "Running %d jobs on %d rigs: %s" % (len(jobs), len(rigs), ', '.join(rigs))
+  workers = [threading.Thread(target=rig_worker, args=(rig, job_queue)) for rig in rigs]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+
+  if not job_queue.empty():
+    print "ERROR: %d jobs could not be run" % job_queue.qsize()
+  for (folder, tests, seed) in failed_jobs:
+    print "ERROR: %s seed %s failed" % (folder, seed)
+
+def get_rigs(rigs_arg):
+  """ Get the rigs to run on. Each rig is identified by the user that it belongs to.
+      'all' selects every user with an ethernet interface and all the devices.
+  """
+  if rigs_arg != 'all':
+    return rigs_arg.split(',')
+
+  with open('eth.json') as f:
+    eth = json.load(f)
+  with open('four.json') as f:
+    config = json.load(f)
+
+  devices = config['endpoints'] + config['analyzers'] + config['generators']
+  return sorted(user for user in eth if all(user in d['users'] for d in devices))
+
+def run_folder(folder):
+  for job in get_jobs([folder]):
+    run_job(job, None)
 
 def run_all():
   for folder in sorted(test_folders):
@@ -138,10 +455,46 @@ def get_current_pids(process_name):
 if __name__ == "__main__":
   active_pids = get_current_pids('xgdb')
 
-  if len(sys.argv) == 1:
+  test_args = sys.argv[1:]
+  if '--warm' in test_args:
+    warm = True
+    test_args.remove('--warm')
+
+  if '--simulate' in test_args:
+    simulate = True
+    test_args.remove('--simulate')
+
+  if '--force' in test_args:
+    force = True
+    test_args.remove('--force')
+
+  harness_hash = get_harness_hash()
+  framework_hash = get_framework_hash()
+
+  # Run on several rigs at once with --rigs=all or --rigs=<user>,<user>
+  rigs = None
+  for arg in list(test_args):
+    if arg.startswith('--rigs='):
+      rigs = get_rigs(arg[len('--rigs='):])
+      test_args.remove(arg)
+
+  load_durations()
+
+  if rigs:
+    folders = []
+    for arg in test_args:
+      if os.path.isdir(os.path.join('configs', arg)):
+        folders.append(os.path.join('configs', arg))
+      elif os.path.isdir(arg):
+        folders.append(arg)
+      else:
+        print "ERROR: Can only run folders on multiple rigs, not '%s'" % arg
+    run_parallel(folders or test_folders.keys(), rigs)
+
+  elif not test_args:
     run_all()
   else:
-    for arg in sys.argv[1:]:
+    for arg in test_args:
       if arg == '--clean':
         backup_folder = os.path.join('backup', time.strftime("%Y_%m_%d_%H_%M_%S"))
         print "Moving old runs to %s" % backup_folder
@@ -168,3 +521,4 @@ if __name__ == "__main__":
       else:
         print "ERROR: Can't find test '%s'" % arg
 
+  save_durations()
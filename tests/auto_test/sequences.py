@@ -1,11 +1,16 @@
-import re
+import collections
 import itertools
+import re
 
 import xmos.test.base as base
-from xmos.test.base import AllOf, OneOf, NoneOf, Sequence, Expected, getActiveProcesses
+from xmos.test.base import getActiveProcesses
+
+# Build all sequences from the template classes so that they can be cached
+from templates import AllOf, OneOf, NoneOf, Sequence, Expected
 
 import analyzers
 import endpoints
+import latency
 import state
 import graph
 
@@ -17,6 +22,47 @@ def get_and_clear_final_port_shaper_states():
   final_port_shaper_states.clear()
   return expected
 
+# The combined patterns for each tuple of patterns that have been merged
+combined_patterns = {}
+
+def combined_pattern(patterns):
+  """ A single pattern which matches any of the patterns given
+  """
+  pattern = combined_patterns.get(patterns)
+  if pattern is None:
+    if len(patterns) == 1:
+      pattern = patterns[0]
+    else:
+      pattern = '|'.join('(?:%s)' % p for p in patterns)
+    combined_patterns[patterns] = pattern
+  return pattern
+
+def merge_none_of(expected):
+  """ Merge all the NoneOf guards in a list of expected sequences into one NoneOf with
+      a single combined pattern per process and timeout. This means that each line of
+      output is matched against one pattern per process rather than one per guard.
+      Guards which have been created with extra arguments are left alone.
+  """
+  merged = []
+  guards = collections.OrderedDict()
+  for e in expected:
+    if isinstance(e, NoneOf) and not e.template_args[1]:
+      children = e.template_args[0][0]
+      if all(isinstance(c, Expected) and len(c.template_args[0]) == 3 and not c.template_args[1]
+          for c in children):
+        for c in children:
+          (process, pattern, timeout) = c.template_args[0]
+          patterns = guards.setdefault((process, timeout), [])
+          if pattern not in patterns:
+            patterns.append(pattern)
+        continue
+    merged.append(e)
+
+  if guards:
+    merged.append(NoneOf([Expected(process, combined_pattern(tuple(patterns)), timeout)
+        for ((process, timeout), patterns) in guards.iteritems()]))
+  return merged
+
 def stream_id_from_guid(user, ep, num):
     stream_id = endpoints.get_avb_id(user, ep).replace("fffe","") + "000" + str(num)
     return stream_id.upper()
@@ -24,7 +70,10 @@ def stream_id_from_guid(user, ep, num):
 def expected_seq(name):
     """ Function to convert from a sequence name to the actual sequence
     """
-    return eval(name + '_seq')
+    try:
+      return sequence_builders[name]
+    except KeyError:
+      base.testError("Unknown sequence '%s'" % name, critical=True)
 
 
 #
@@ -55,7 +104,7 @@ def controller_enumerate_seq(args, test_step, endpoint_name):
             if element_type == 'hex':
               temp_string = "%s\s*=\s*0x%x" % (element['item'], element['value'])
             elif element_type == 'state':
-              value = eval('state.get_current().get_%s' % element['item'])(endpoint_name)
+              value = state.state_accessors[element['item']](state.get_current(), endpoint_name)
               temp_string = "%s\s*=\s*%s" % (element['item'], value)
             else:
               temp_string = "%s\s*=\s*%s" % (element['item'], element['value'])
@@ -73,7 +122,7 @@ def controller_enumerate_seq(args, test_step, endpoint_name):
             if element_type == 'flag':
               temp_string = "%s\s*=\s*1" % element['value'].lower()
             elif element_type == 'state':
-              value = eval('state.get_current().get_%s' % element['item'])(endpoint_name)
+              value = state.state_accessors[element['item']](state.get_current(), endpoint_name)
               temp_string = "%s\s*=\s*%s" % (element['item'], value)
             else:
               temp_string = "%s\s*=\s*%s" % (element['item'], element['value'])
@@ -373,14 +422,21 @@ def analyzer_listener_disconnect_seq(test_step, src, src_stream, dst, dst_stream
           "Channel %d: %s" % (i + analyzer_offset, GLITCH_DETECTED_PATTERN)]))
       for i in range(0, 2)
   ]
+  return signal_lost
 
-  # Unregister the lost signal error pattern now
-  process = getActiveProcesses()[analyzer_name]
+def analyzer_listener_disconnect_unregister_errors(dst):
+  """ When a listener is disconnected its analyzer channels will lose signal, so
+      that must no longer be treated as an error. This needs to be done as soon as
+      the disconnect is issued rather than when the sequence is matched.
+  """
+  listener_ep = endpoints.get(dst)
+  analyzer = listener_ep['analyzer']
+  analyzer_offset = listener_ep['analyzer_offset'] + analyzer['base']
+
+  process = getActiveProcesses()[analyzer['name']]
   for i in range(0, 2):
     process.unregisterErrorPattern("Channel %d: %s" % (i + analyzer_offset, LOST_SIGNAL_PATTERN))
 
-  return signal_lost
-
 def analyzer_listener_redundant_disconnect_seq(test_step, src, src_stream, dst, dst_stream):
   return []
 
@@ -412,3 +468,17 @@ def analyzer_qav_seq(test_step, src, dst, action, user):
 
   return analyzer_expect
 
+def get_sequence_builders():
+  """ Get all the sequence builders by name (without the _seq suffix). The module
+      functions are replaced by versions wrapped to record their kind, so that direct
+      calls also record it.
+  """
+  builders = {}
+  for (name, fn) in globals().items():
+    if name.endswith('_seq') and name != 'expected_seq' and callable(fn):
+      kind = name[:-len('_seq')]
+      builders[kind] = globals()[name] = latency.with_kind(kind, fn)
+  return builders
+
+# Built once at import so that looking up a sequence is just a dictionary access
+sequence_builders = get_sequence_builders()
@@ -0,0 +1,237 @@
+""" Run test configurations against the model of the topology without any hardware.
+
+    The action functions are driven exactly as test.py drives them, but against a
+    simulated master which records the commands sent and collects the expected
+    message trees for each check instead of matching them against process output.
+    No processes are started and no time is spent sleeping, so a large number of
+    random seeds can be run to find problems in the harness and the model, and to
+    measure how long the planning of each step takes.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import traceback
+
+from path_setup import *
+
+import xmos.test.base as base
+import xmos.test.xmos_logging as xmos_logging
+import xmos.test.generator as generator
+from xmos.test.base import AllOf, getActiveProcesses
+from xmos.test.xmos_logging import log_error, log_info
+
+from actions import *
+import actions
+import analyzers
+import endpoints
+import generators
+import graph
+import sequences
+import state
+
+class SimulatedMaster(object):
+  """ Stands in for the test master. Commands are recorded and the expected
+      message trees are collected per check rather than being waited for.
+  """
+  def __init__(self):
+    self.nextExpected = []
+    self.checks = []
+    self.commands = []
+
+  def sendLine(self, process_name, line):
+    self.commands.append((process_name, line))
+
+  def addExpected(self, expected):
+    self.nextExpected.append(expected)
+
+  def startNext(self):
+    self.checks.append(self.nextExpected)
+    self.nextExpected = []
+
+  def expect(self, expected=None):
+    return None
+
+  def clearExpectHistory(self, process_name):
+    pass
+
+
+class SimulatedProcess(object):
+  """ Stands in for a process so that error patterns can be registered against it
+  """
+  def __init__(self, name):
+    self.name = name
+    self.error_patterns = set()
+
+  def registerErrorPattern(self, pattern):
+    self.error_patterns.add(pattern)
+
+  def unregisterErrorPattern(self, pattern):
+    self.error_patterns.discard(pattern)
+
+
+class SimulatedController(SimulatedProcess):
+  """ A controller which can see exactly the entities the model says it can
+  """
+  @property
+  def entities(self):
+    visible = graph.get_endpoints_connected_to(state.get_current(), self.name)
+    return dict((name, 1) for name in visible)
+
+  def wait_for_entities_available(self, guids, timeout):
+    return None
+
+  def wait_for_listing(self, timeout):
+    return None
+
+
+def register_processes(config):
+  processes = getActiveProcesses()
+  processes.clear()
+  for name in endpoints.get_all().keys() + analyzers.get_all().keys() + generators.get_all().keys():
+    processes[name] = SimulatedProcess(name)
+
+  controller_id = config['controller']['name']
+  processes[controller_id] = SimulatedController(controller_id)
+
+def run_steps(args, test_steps):
+  """ Run the test steps in the same way as test.runTest, but without waiting for
+      anything. Returns the number of steps run.
+  """
+  expected = []
+  for y in action_discover(args, generator.Command("discover"), expected, []):
+    pass
+
+  num_steps = 0
+  for test_step in test_steps:
+    state.move_next_to_current()
+
+    command = test_step.get_command()
+    if command is None:
+      continue
+
+    num_steps += 1
+    action = command.split(' ')
+    action_function = get_action_function(action[0])
+    expected = []
+    for y in action_function(args, test_step, expected, action[1:]):
+      pass
+    if expected:
+      args.master.addExpected(AllOf(expected))
+
+    if (test_step.checkpoint or test_step.checkpoint is None) and args.master.nextExpected:
+      args.master.startNext()
+
+  return num_steps
+
+def write_checks(f, seed, master):
+  f.write("Seed %d\n" % seed)
+  for check_num,check in enumerate(master.checks):
+    f.write("Check: %d\n" % (check_num + 1))
+    for expected in check:
+      f.write("  %s\n" % expected)
+
+def run_test(args, test_name, output):
+  """ Run a test file once for each seed. Returns the number of seeds which failed.
+  """
+  with open(test_name) as f:
+    test_text = f.read()
+
+  test_config = json.loads(test_text)
+  check_test_config(test_config)
+
+  # Start from the seed in the test file, unless overridden by the command-line
+  first_seed = args.first_seed
+  if first_seed is None:
+    first_seed = test_config.get('seed', 1)
+  seeds = range(first_seed, first_seed + args.seeds)
+
+  # Apply any analyzer types specified by the test file
+  analyzers.configure(args, args.config_data['analyzers'], test_config)
+
+  failures = 0
+  num_steps = 0
+  t_start = time.time()
+  for seed in seeds:
+    # Need to set the seed before reading the test_steps as it uses random
+    random.seed(seed)
+    test_steps = json.loads(test_text, object_hook=generator.json_hooks)
+
+    state.reset()
+    sequences.get_and_clear_final_port_shaper_states()
+    args.master = SimulatedMaster()
+
+    try:
+      num_steps += run_steps(args, test_steps)
+    except Exception:
+      failures += 1
+      log_error("%s seed %d failed:\n%s" % (test_name, seed, traceback.format_exc()))
+
+    if output:
+      write_checks(output, seed, args.master)
+
+  t_end = time.time()
+  log_info("%s: %d seeds, %d steps, %d failed in %.3fs (%.0f steps/s)" % (test_name,
+        len(seeds), num_steps, failures, t_end - t_start, num_steps / max(t_end - t_start, 1e-6)))
+  return failures
+
+def get_test_files(tests):
+  test_files = []
+  for test in tests:
+    if os.path.isdir(test):
+      test_files += sorted(os.path.join(test, f) for f in os.listdir(test) if f.endswith('.json'))
+    elif not os.path.exists(test):
+      test_files.append(test + '.json')
+    else:
+      test_files.append(test)
+  return test_files
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run test configurations against the model")
+  parser.add_argument('--config', nargs='?', help="name of .json topology file", default='four.json')
+  parser.add_argument('--user', nargs='?', help="username (defaults to the first user in the json config file)", default=None)
+  parser.add_argument('--seeds', type=int, nargs='?', help="number of random seeds to run", default=1)
+  parser.add_argument('--first-seed', type=int, nargs='?', help="first random seed (defaults to the seed of the test)", default=None)
+  parser.add_argument('--types', nargs='*', help="override the types of devices", default="")
+  parser.add_argument('--controller-type', choices=['c', 'python'], help="controller type", default='c')
+  parser.add_argument('--output', nargs='?', help="file to write the expected checks to", default=None)
+  parser.add_argument('tests', nargs='+', help="test .json files or folders of them")
+  args = parser.parse_args()
+
+  xmos_logging.configure_logging(level_console='INFO', level_file='ERROR')
+
+  with open(args.config) as f:
+    config = json.load(f)
+
+  # No boards are used, so any user the config file knows about will do
+  if args.user is None:
+    args.user = sorted(config['endpoints'][0]['users'].keys())[0]
+  args.config_data = config
+
+  actions.set_sleep_function(lambda seconds: None)
+  graph.set_connections(config['port_connections'])
+
+  generators.configure(args, config['generators'])
+  analyzers.configure(args, config['analyzers'], {})
+  endpoints.configure(args, config['endpoints'])
+  register_processes(config)
+  args.controller_id = config['controller']['name']
+
+  output = None
+  if args.output:
+    output = open(args.output, 'w')
+
+  failures = 0
+  for test_name in get_test_files(args.tests):
+    failures += run_test(args, test_name, output)
+
+  if output:
+    output.close()
+
+  cache = actions.expected_templates
+  log_info("Expected templates: %d cached, %d hits, %d misses" % (len(cache.templates), cache.hits, cache.misses))
+
+  sys.exit(1 if failures else 0)
@@ -0,0 +1,602 @@
+""" Stand-ins for the devices of a rig so that test.py can be run without any hardware.
+
+    A single hub takes the place of every process which would be launched: the
+    endpoints, analyzers, generators and the controller. Commands sent to the
+    controller and analyzers are applied to a model of the rig (the same State and
+    graph which are used to build the expected sequences) and the hub prints the
+    console output the real devices would, each line after a random delay. Lines from
+    one device are always printed in order.
+
+    Run on its own, this writes a rig configuration of a daisy chain of any number of
+    endpoints for the stand-ins to emulate.
+"""
+import argparse
+import json
+import random
+import re
+
+from twisted.internet import reactor
+
+from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
+
+import analyzers
+import endpoints
+import generators
+import graph
+import replay
+import sequences
+import state
+
+# Delays (in seconds) from a command to each stage of the response. The devices
+# respond to a connection in this order on the real rigs.
+STARTUP_DELAY = 1
+CONTROLLER_DELAY = 0.05
+TALKER_DELAY = 0.1
+FORWARD_DELAY = 0.2
+LISTENER_DELAY = 0.4
+ANALYZER_DELAY = 0.8
+
+# The time after which a talker stops streaming to a listener it cannot reach
+LINK_TIMEOUT = 10
+
+# The minimum time between two lines from one device, which keeps them in order
+LINE_INTERVAL = 0.001
+
+class StandinTransport(replay.ReplayTransport):
+  """ Passes each line sent to a process on to the hub
+  """
+  def __init__(self, process_protocol, hub):
+    replay.ReplayTransport.__init__(self, process_protocol)
+    self.hub = hub
+    self.partial_line = ''
+
+  def write(self, data):
+    lines = (self.partial_line + data).split('\n')
+    self.partial_line = lines.pop()
+    for line in lines:
+      self.hub.command(self.process_protocol.name, line.strip())
+
+class StandinHub(object):
+  """ Emulates all the devices of a rig. The random delays use their own generator so
+      that the choices made by the test are not changed.
+  """
+  def __init__(self, args, controller_id, jitter=0.05, seed=1):
+    self.user = args.user
+    self.controller_type = args.controller_type
+    self.controller_id = controller_id
+    self.jitter = jitter
+    self.random = random.Random(seed)
+    self.model = state.State()
+    self.processes = {}
+    self.last_output = {}
+    self.visible = set()
+    self.selected = None
+    self.analyzer_bases = {}
+    self.lost_connections = {}
+
+  def spawn(self, process_protocol, executable, args=(), env=None, path=None, **kwargs):
+    """ Used in place of reactor.spawnProcess
+    """
+    name = process_protocol.name
+    transport = StandinTransport(process_protocol, self)
+    process_protocol.makeConnection(transport)
+    self.processes[name] = process_protocol
+
+    if endpoints.get(name):
+      self.start_endpoint(endpoints.get(name))
+    elif analyzers.get(name):
+      self.emit(name, STARTUP_DELAY, "connected to localhost: %d" % analyzers.get_port(name))
+    elif generators.get(name):
+      self.emit(name, STARTUP_DELAY, "connected to localhost: %d" % generators.get_port(name))
+    elif name == self.controller_id:
+      self.start_controller()
+
+    # The xrun processes of the analyzers and generators print nothing of interest
+    return transport
+
+  def emit(self, name, delay, line):
+    """ Print a line from a device after the delay plus some jitter
+    """
+    self.emit_block(name, delay, [line])
+
+  def emit_block(self, name, delay, lines):
+    """ Print several lines from a device at once, as a device does when it prints a
+        table
+    """
+    now = reactor.seconds()
+    when = max(now + delay + self.random.uniform(0, self.jitter),
+               self.last_output.get(name, now) + LINE_INTERVAL)
+    self.last_output[name] = when
+    reactor.callLater(when - now, self.output, name, ''.join(line + '\n' for line in lines))
+
+  def output(self, name, data):
+    process_protocol = self.processes.get(name)
+    if process_protocol is not None:
+      process_protocol.outReceived(data)
+
+  def guid(self, name):
+    return endpoints.guid_in_ascii(self.user, endpoints.get(name))
+
+  def get_endpoint_name(self, guid_string):
+    guid = int(guid_string, 16)
+    for name in endpoints.get_all():
+      if int(self.guid(name), 16) == guid:
+        return name
+    return None
+
+  #
+  # Start up
+  #
+  def start_endpoint(self, ep):
+    name = ep['name']
+    grandmaster = endpoints.determine_grandmaster(self.user)
+    is_grandmaster = grandmaster is None or grandmaster['name'] == name
+
+    if ep['ports'] == 2:
+      lines = ["PTP Port 0 Role: Master", "PTP Port 1 Role: Master"]
+      if not is_grandmaster:
+        lines += ["PTP Port 0 Role: Slave", "PTP sync locked"]
+    else:
+      lines = ["PTP Role: Master"]
+      if not is_grandmaster:
+        lines += ["PTP Role: Slave", "PTP sync locked"]
+
+    index = sorted(endpoints.get_all().keys()).index(name)
+    for n in range(ep['talker_streams']):
+      lines.append("MAAP reserved Talker stream #%d address: 91:E0:F0:00:%02X:%02X" % (n, index, n))
+
+    for line in lines:
+      self.emit(name, STARTUP_DELAY, line)
+
+  def start_controller(self):
+    self.visible = set(graph.get_endpoints_connected_to(self.model, self.controller_id))
+    if self.controller_type == 'c':
+      for name in sorted(self.visible):
+        self.notify_entity(name, 'END_STATION_CONNECTED', 2 * STARTUP_DELAY)
+
+  def notify_entity(self, name, notification, delay):
+    self.emit(self.controller_id, delay, "[NOTIFICATION] (%s, 0x%s, 0, 0, 0)" %
+        (notification, self.guid(name).zfill(16)))
+
+  def update_visible(self):
+    """ Notify the controller of the entities which appear or depart as relays change
+    """
+    visible = set(graph.get_endpoints_connected_to(self.model, self.controller_id))
+    if self.controller_type == 'c':
+      for name in sorted(visible - self.visible):
+        self.notify_entity(name, 'END_STATION_CONNECTED', CONTROLLER_DELAY)
+      for name in sorted(self.visible - visible):
+        self.notify_entity(name, 'END_STATION_DISCONNECTED', CONTROLLER_DELAY)
+    self.visible = visible
+
+  #
+  # Commands
+  #
+  def command(self, name, line):
+    if not line:
+      return
+
+    log_debug("Stand-in %s: %s" % (name, line))
+    if name == self.controller_id:
+      self.controller_command(line.split())
+    elif analyzers.get(name):
+      self.analyzer_command(name, line.split())
+    elif generators.get(name):
+      if line == 'p':
+        self.emit(name, CONTROLLER_DELAY, "Current configuration")
+
+  def controller_command(self, fields):
+    command = fields[0]
+    if command == 'list':
+      self.list_entities()
+    elif command == 'discover':
+      self.discover_entities()
+    elif command in ['connect', 'disconnect']:
+      src = self.get_endpoint_name(fields[1])
+      dst = self.get_endpoint_name(fields[3])
+      if command == 'connect':
+        self.connect(src, int(fields[2]), dst, int(fields[4]))
+      else:
+        self.disconnect(src, int(fields[2]), dst, int(fields[4]))
+    elif command == 'show':
+      self.show_connections()
+    elif command == 'select':
+      self.selected = self.get_endpoint_name(fields[1])
+    elif command == 'view':
+      self.view_descriptor(self.selected, fields[2])
+    elif command == 'enumerate':
+      self.enumerate_descriptors(self.get_endpoint_name(fields[1]))
+    elif command in ['set_clock_source_master', 'set_clock_source_slave']:
+      self.set_clock_source(self.get_endpoint_name(fields[1]), command == 'set_clock_source_master')
+    elif command == 'set' and fields[1] == 'clock_source':
+      self.set_clock_source(self.selected, fields[-1] == '1')
+    elif command == 'identify':
+      self.identify([f for f in fields if f.startswith('0x')][0], 'on' in fields)
+    else:
+      log_warning("Stand-in controller: unknown command '%s'" % ' '.join(fields))
+
+  def controller_response(self, response, status):
+    """ Print the result of a command in the form of the controller in use
+    """
+    if self.controller_type == 'python':
+      if status == 'SUCCESS':
+        line = "Success"
+      else:
+        line = "Failed with status %s" % status
+    else:
+      line = "[NOTIFICATION] (RESPONSE_RECEIVED, 0x0, %s, 0, 0, %s)" % (response, status)
+    self.emit(self.controller_id, CONTROLLER_DELAY, line)
+
+  def list_entities(self):
+    lines = ["End Station  |  Name                  |  Entity GUID         |  MAC"]
+    for (index, name) in enumerate(sorted(self.visible)):
+      lines.append("C  %d  |  %-20s  |  0x%s  |  %s" % (index, name, self.guid(name).zfill(16),
+          endpoints.mac_in_ascii(self.user, endpoints.get(name))))
+    lines.append("C - End Station list complete")
+    self.emit_block(self.controller_id, CONTROLLER_DELAY, lines)
+
+  def discover_entities(self):
+    lines = ["Found %d entities" % len(self.visible)]
+    for name in sorted(self.visible):
+      lines.append("0x%s  %s" % (self.guid(name), name))
+    self.emit_block(self.controller_id, CONTROLLER_DELAY, lines)
+
+  def show_connections(self):
+    lines = []
+    for c in sorted(self.model.active_connections.keys(), key=str):
+      src_guid = self.guid(c.talker.src)
+      dst_guid = self.guid(c.listener.dst)
+      if self.controller_type == 'c':
+        (src_guid, dst_guid) = (src_guid.zfill(16), dst_guid.zfill(16))
+      lines.append("0x%s[%d] -> 0x%s[%d]" % (src_guid, c.talker.src_stream, dst_guid, c.listener.dst_stream))
+    if lines:
+      self.emit_block(self.controller_id, CONTROLLER_DELAY, lines)
+
+  def descriptor_lines(self, name, dtor, descriptors):
+    """ The lines printed for one descriptor of an endpoint
+    """
+    dtor_type = re.sub('\d*_', '', dtor, 1)
+    if self.controller_type == 'python':
+      lines = ["AVB 1722.1 %s descriptor" % dtor_type]
+    else:
+      lines = ["descriptor_type: %s" % dtor_type]
+
+    for dtor_name in descriptors[dtor].keys():
+      if self.controller_type == 'python':
+        lines.append("object_name = '%s'" % dtor_name)
+      else:
+        lines.append("object_name = %s" % dtor_name)
+
+      for element in descriptors[dtor][dtor_name]:
+        element_type = element.get('type', 'none')
+        if element_type == 'state':
+          value = state.state_accessors[element['item']](self.model, name)
+          lines.append("%s = %s" % (element['item'], value))
+        elif element_type == 'hex' and self.controller_type == 'python':
+          lines.append("%s = 0x%x" % (element['item'], element['value']))
+        elif element_type == 'flag' and self.controller_type == 'c':
+          lines.append("%s = 1" % element['value'].lower())
+        else:
+          lines.append("%s = %s" % (element['item'], element['value']))
+    return lines
+
+  def enumerate_descriptors(self, name):
+    if name not in self.visible:
+      self.emit(self.controller_id, CONTROLLER_DELAY, "No descriptors found")
+      return
+
+    descriptors = endpoints.get(name)['descriptors']
+    lines = []
+    for dtor in sorted(descriptors.keys()):
+      lines += self.descriptor_lines(name, dtor, descriptors)
+    self.emit_block(self.controller_id, CONTROLLER_DELAY, lines)
+
+  def view_descriptor(self, name, dtor_type):
+    descriptors = endpoints.get(name)['descriptors']
+    for dtor in sorted(descriptors.keys()):
+      if re.sub('\d*_', '', dtor, 1) == dtor_type:
+        self.emit_block(self.controller_id, CONTROLLER_DELAY, self.descriptor_lines(name, dtor, descriptors))
+
+  def set_clock_source(self, name, is_master):
+    if is_master:
+      self.model.set_clock_source_master(name)
+      self.emit(name, TALKER_DELAY, "Setting clock source: LOCAL_CLOCK")
+    else:
+      self.model.set_clock_source_slave(name)
+      self.emit(name, TALKER_DELAY, "Setting clock source: INPUT_STREAM_DERIVED")
+    self.controller_response('SET_CLOCK_SOURCE', 'SUCCESS')
+
+  def identify(self, guid_string, on):
+    if on:
+      self.emit(self.get_endpoint_name(guid_string), TALKER_DELAY, "IDENTIFY Ping")
+    self.controller_response('SET_CONTROL', 'SUCCESS')
+
+  #
+  # Connections
+  #
+  def connect(self, src, src_stream, dst, dst_stream):
+    before = self.model.copy()
+    controller_state = before.get_controller_state(self.controller_id, src, src_stream, dst, dst_stream, 'connect')
+    talker_state = before.get_talker_state(src, src_stream, dst, dst_stream, 'connect')
+    listener_state = before.get_listener_state(src, src_stream, dst, dst_stream, 'connect')
+    forwarding = graph.get_forwarding_changes(before, src, src_stream, dst, dst_stream, 'connect')
+    path = graph.find_path(before, src, dst) or []
+    self.model.connect(src, src_stream, dst, dst_stream)
+
+    status = {
+      'controller_success_connect' : 'SUCCESS',
+      'controller_listener_exclusive_connect' : 'LISTENER_EXCLUSIVE',
+      'controller_listener_talker_timeout_connect' : 'LISTENER_TALKER_TIMEOUT',
+    }.get(controller_state)
+    if status is None:
+      self.emit(self.controller_id, CONTROLLER_DELAY, "Timed out")
+    else:
+      self.controller_response('CONNECT_RX_RESPONSE', status)
+
+    talker_first_on = not before.get_talker_on_count(src)
+    if talker_state in ['talker_new_connect', 'talker_existing_connect']:
+      self.emit(src, TALKER_DELAY, "CONNECTING Talker stream #%d (%s) -> Listener %s" % (src_stream,
+          endpoints.stream_from_guid(self.guid(src)), endpoints.mac_in_ascii(self.user, endpoints.get(dst))))
+    if talker_state in ['talker_new_connect', 'talker_self_connect'] and talker_first_on:
+      self.emit(src, TALKER_DELAY, "Talker stream #%d ready" % src_stream)
+    if talker_state == 'talker_new_connect':
+      self.emit(src, TALKER_DELAY, "Talker stream #%d on" % src_stream)
+
+    for node in forwarding:
+      self.forwarding(node, src, 'Enabled')
+
+    if not before.connected(src, src_stream, dst, dst_stream) and not before.listener_active_count(dst, dst_stream):
+      self.shaper_changes(before, src, src_stream, dst, 'connect', 'Increasing')
+
+    if listener_state == 'listener_connect':
+      ep = endpoints.get(dst)
+      self.emit(dst, LISTENER_DELAY, "CONNECTING Listener sink #%d" % dst_stream)
+      for n in range(ep['in_channels']):
+        self.emit(dst, LISTENER_DELAY, "%d -> %d" % (n, n))
+      for n in range(ep['in_channels']):
+        self.emit(dst, LISTENER_DELAY, "Media output %d locked" % n)
+      self.signal_detected(src, dst)
+
+    self.qav_streams(path, src, 'Adding')
+
+  def disconnect(self, src, src_stream, dst, dst_stream):
+    before = self.model.copy()
+    controller_state = before.get_controller_state(self.controller_id, src, src_stream, dst, dst_stream, 'disconnect')
+    talker_state = before.get_talker_state(src, src_stream, dst, dst_stream, 'disconnect')
+    listener_state = before.get_listener_state(src, src_stream, dst, dst_stream, 'disconnect')
+    forwarding = graph.get_forwarding_changes(before, src, src_stream, dst, dst_stream, 'disconnect')
+    path = graph.find_path(before, src, dst) or []
+    self.model.disconnect(src, src_stream, dst, dst_stream)
+
+    if controller_state == 'controller_success_disconnect':
+      self.controller_response('DISCONNECT_RX_RESPONSE', 'SUCCESS')
+    elif controller_state == 'controller_redundant_disconnect':
+      self.controller_response('DISCONNECT_RX_RESPONSE', 'NOT_CONNECTED')
+    else:
+      self.emit(self.controller_id, CONTROLLER_DELAY, "Timed out")
+
+    if talker_state in ['talker_all_disconnect', 'talker_existing_disconnect']:
+      self.emit(src, TALKER_DELAY, "DISCONNECTING Talker stream #%d" % src_stream)
+    if talker_state == 'talker_all_disconnect':
+      self.emit(src, TALKER_DELAY, "Talker stream #%d off" % src_stream)
+
+    for node in forwarding:
+      self.forwarding(node, src, 'Disabled')
+
+    if before.connected(src, src_stream, dst, dst_stream):
+      self.shaper_changes(before, src, src_stream, dst, 'disconnect', 'Decreasing')
+
+    if listener_state == 'listener_disconnect':
+      self.emit(dst, LISTENER_DELAY, "DISCONNECTING Listener sink #%d" % dst_stream)
+      self.signal_lost(dst)
+
+    self.qav_streams(path, src, 'Removing')
+
+  def forwarding(self, node, src, action):
+    if endpoints.get(node) and endpoints.get(node)['ports'] == 2:
+      self.emit(node, FORWARD_DELAY, "1722 router: %s forwarding for stream %s" %
+          (action, sequences.stream_id_from_guid(self.user, endpoints.get(src), 0)))
+
+  def shaper_changes(self, before, src, src_stream, dst, command, action):
+    """ Print the new shaper bandwidth on every port that changes for a connection
+    """
+    for (name, ep) in sorted(endpoints.get_all().iteritems()):
+      if ep['ports'] != 2:
+        continue
+      port = graph.get_forward_port(before, src, dst, name)
+      if port is not None and graph.port_will_see_bandwidth_change(before, src, src_stream, name, port, command):
+        self.emit(name, FORWARD_DELAY, "%s port %d shaper bandwidth to %s" %
+            (action, port, graph.calculate_expected_bandwidth(self.model, ep, port)))
+
+  def reroute_changes(self, before):
+    """ Print the forwarding and shaper changes of the streams which move when a relay
+        is opened or closed
+    """
+    for talker in sorted(graph.get_rerouted_talkers(before, self.model), key=str):
+      old_nodes = graph.get_forwarding_nodes(before, talker)
+      new_nodes = graph.get_forwarding_nodes(self.model, talker)
+      for node in sorted(new_nodes - old_nodes):
+        self.forwarding(node, talker.src, 'Enabled')
+      for node in sorted(old_nodes - new_nodes):
+        self.forwarding(node, talker.src, 'Disabled')
+
+    for (node, port) in graph.get_changed_reservations(before, self.model):
+      if self.model.get_port_bandwidth(node, port) > before.get_port_bandwidth(node, port):
+        action = 'Increasing'
+      else:
+        action = 'Decreasing'
+      self.emit(node, FORWARD_DELAY, "%s port %d shaper bandwidth to %s" %
+          (action, port, graph.calculate_expected_bandwidth(self.model, endpoints.get(node), port)))
+
+  def signal_detected(self, src, dst):
+    listener_ep = endpoints.get(dst)
+    analyzer = listener_ep['analyzer']
+    for i in range(0, 2):
+      channel = i + listener_ep['analyzer_offset'] + analyzer['base']
+      self.emit(analyzer['name'], ANALYZER_DELAY, "Channel %d: Signal detected" % channel)
+      self.emit(analyzer['name'], ANALYZER_DELAY, "Channel %d: Frequency %d" %
+          (channel, analyzers.siggen_frequency(endpoints.get(src), i)))
+
+  def signal_lost(self, dst):
+    listener_ep = endpoints.get(dst)
+    analyzer = listener_ep['analyzer']
+    for i in range(0, 2):
+      channel = i + listener_ep['analyzer_offset'] + analyzer['base']
+      self.emit(analyzer['name'], ANALYZER_DELAY, "Channel %d: Lost signal" % channel)
+
+  def qav_streams(self, path, src, action):
+    for node in path:
+      analyzer = analyzers.get(node)
+      if analyzer is not None and analyzer['type'] == 'qav':
+        self.emit(node, ANALYZER_DELAY, "%s stream 0x%s" % (action, endpoints.stream_from_guid(self.guid(src))))
+
+  #
+  # Analyzers
+  #
+  def analyzer_command(self, name, fields):
+    analyzer = analyzers.get(name)
+    command = ' '.join(fields[:2])
+    if command == 'r o':
+      self.open_relay(name)
+    elif command == 'r c':
+      self.close_relay(name)
+    elif analyzer['type'] != 'audio':
+      pass
+    elif command == 'd a':
+      for chan in range(len(analyzer['frequencies'])):
+        self.emit(name, CONTROLLER_DELAY, "Channel %d: disabled" % chan)
+    elif fields[0] == 'b':
+      self.analyzer_bases[name] = int(fields[1])
+    elif fields[0] == 'c':
+      self.emit(name, CONTROLLER_DELAY, "Generating sine table for chan %d" %
+          (int(fields[1]) - self.analyzer_bases.get(name, 0)))
+    elif command == 'e a':
+      for chan in sorted(int(c) for c in analyzer['frequencies'].keys()):
+        self.emit(name, CONTROLLER_DELAY, "Channel %d: enabled" % (chan - self.analyzer_bases.get(name, 0)))
+
+  def open_relay(self, name):
+    before = self.model.copy()
+    self.model.set_relay_open(name)
+    self.reroute_changes(before)
+    self.update_visible()
+
+    # Connections with no other path lose their audio and are dropped if the relay
+    # stays open for too long
+    lost = [c for c in sorted(self.model.active_connections.keys(), key=str)
+            if name in self.model.connection_paths.get(c, [])]
+    for c in lost:
+      self.signal_lost(c.listener.dst)
+    self.lost_connections[name] = lost
+    reactor.callLater(LINK_TIMEOUT, self.link_timeout, name, lost)
+
+  def close_relay(self, name):
+    before = self.model.copy()
+    self.model.set_relay_closed(name)
+    self.reroute_changes(before)
+    self.update_visible()
+
+    for c in self.lost_connections.pop(name, []):
+      self.signal_detected(c.talker.src, c.listener.dst)
+
+  def link_timeout(self, name, lost):
+    if self.lost_connections.get(name) is not lost:
+      return
+
+    del self.lost_connections[name]
+    for c in lost:
+      self.model.disconnect(c.talker.src, c.talker.src_stream, c.listener.dst, c.listener.dst_stream)
+      if not self.model.talker_active_count(c.talker.src, c.talker.src_stream):
+        self.emit(c.talker.src, TALKER_DELAY, "Talker stream #%d off" % c.talker.src_stream)
+
+
+#
+# Rig configurations
+#
+def chain_endpoint(user, index, analyzer_name, analyzer_offset):
+  return {
+    'name' : 'dc%d' % index,
+    'users' : { user : { 'xrun_adapter_id' : 'standin%d' % index,
+                         'avb_id' : '2297fffe%06x' % (0x005200 + index) } },
+    'ports' : 2,
+    'sample_rate' : 48000,
+    'out_channels' : 4,
+    'talker_streams' : 1,
+    'in_channels' : 4,
+    'listener_streams' : 1,
+    'analyzer' : analyzer_name,
+    'analyzer_offset' : analyzer_offset,
+    'descriptors' : {
+      '1_CONFIGURATION' : { 'Configuration 0' : [
+        { 'item' : 'descriptor_counts_count', 'value' : 10 } ] },
+      '3_CLOCK_DOMAIN' : { 'Clock Domain' : [
+        { 'item' : 'clock_source_index', 'value' : 0, 'type' : 'state' },
+        { 'item' : 'clock_sources_count', 'value' : 2 } ] },
+      '4_STREAM_INPUT' : { 'Input 0' : [
+        { 'item' : 'stream_flags', 'value' : 'CLASS_A', 'type' : 'flag' } ] },
+      '5_STREAM_OUTPUT' : { 'Output 0' : [
+        { 'item' : 'stream_flags', 'value' : 'CLASS_A', 'type' : 'flag' } ] },
+    }
+  }
+
+def chain_config(num_endpoints, user):
+  """ A daisy chain of endpoints with the controller at one end. Each audio analyzer
+      listens to two endpoints and the first one is also a relay in the middle of
+      the chain so that links can be broken.
+  """
+  config = {
+    'controller' : { 'name' : 'c1' },
+    'endpoints' : [],
+    'analyzers' : [],
+    'generators' : [ { 'name' : 'gen0', 'port' : 12347,
+                       'users' : { user : { 'xrun_adapter_id' : 'standin_gen0' } } } ],
+    'port_connections' : { 'c1' : ['dc0_0'] },
+  }
+
+  for index in range(num_endpoints):
+    analyzer_index = index / 2
+    if index % 2 == 0:
+      channels = range(4 * analyzer_index, 4 * analyzer_index + 4)
+      config['analyzers'].append({
+        'name' : 'analyzer%d' % analyzer_index,
+        'type' : 'audio',
+        'port' : 12348 + analyzer_index,
+        'base' : channels[0],
+        'frequencies' : dict(('%d' % c, 1000 + 250 * (c % 64)) for c in channels),
+        'users' : { user : { 'xrun_adapter_id' : 'standin_analyzer%d' % analyzer_index } },
+      })
+    config['endpoints'].append(chain_endpoint(user, index, 'analyzer%d' % analyzer_index, 2 * (index % 2)))
+
+  # Link each endpoint to the next, going through the relay half way along
+  connections = config['port_connections']
+  connections['dc0_0'] = ['dc0', 'c1']
+  relay_index = num_endpoints / 2
+  for index in range(num_endpoints):
+    connections['dc%d' % index] = ['dc%d_0' % index, 'dc%d_1' % index]
+    if index + 1 == num_endpoints:
+      connections['dc%d_1' % index] = ['dc%d' % index]
+    elif index + 1 == relay_index:
+      connections['dc%d_1' % index] = ['dc%d' % index, 'analyzer0_0']
+      connections['analyzer0'] = ['analyzer0_0', 'analyzer0_1']
+      connections['analyzer0_0'] = ['analyzer0', 'dc%d_1' % index]
+      connections['analyzer0_1'] = ['analyzer0', 'dc%d_0' % (index + 1)]
+      connections['dc%d_0' % (index + 1)] = ['dc%d' % (index + 1), 'analyzer0_1']
+    else:
+      connections['dc%d_1' % index] = ['dc%d' % index, 'dc%d_0' % (index + 1)]
+      connections['dc%d_0' % (index + 1)] = ['dc%d' % (index + 1), 'dc%d_1' % index]
+
+  return config
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Write a daisy chain rig configuration for the stand-ins")
+  parser.add_argument('--endpoints', type=int, nargs='?', help="number of endpoints in the chain", default=32)
+  parser.add_argument('--user', nargs='?', help="username to give the devices", default='standin')
+  parser.add_argument('--output', nargs='?', help="name of .json file to write", required=True)
+  args = parser.parse_args()
+
+  if args.endpoints < 2:
+    log_error("A chain needs at least two endpoints")
+    raise SystemExit(1)
+
+  with open(args.output, 'w') as f:
+    json.dump(chain_config(args.endpoints, args.user), f, indent=4, sort_keys=True)
@@ -0,0 +1,124 @@
+""" Start the processes for a test.
+
+    Rather than starting each process after a fixed delay, processes are launched
+    with a bounded number starting at once. A process holds its slot until it prints
+    a line showing that it is ready, at which point the next process is launched.
+    The output of all the processes started here is also added to the event log.
+"""
+import re
+
+from twisted.internet import reactor
+
+import xmos.test.process as process
+from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
+
+import events
+
+# The function used to launch each process. This is replaced when replaying a recorded
+# run or using stand-ins so that the output comes from them instead.
+spawn_process = reactor.spawnProcess
+
+def set_spawn_function(spawn_function):
+  global spawn_process
+  spawn_process = spawn_function
+
+class ReadinessMixin(object):
+  """ Watches the output of a process for the first line showing that it is ready
+      and then calls the function registered for it.
+  """
+  def set_ready_pattern(self, pattern, ready_fn):
+    self.ready_pattern = re.compile(pattern)
+    self.ready_fn = ready_fn
+    self.ready_tail = ''
+
+  def check_ready(self, data):
+    ready_fn = getattr(self, 'ready_fn', None)
+    if ready_fn is None:
+      return
+
+    # Keep the end of the previous output in case the line was split
+    text = self.ready_tail + data
+    if self.ready_pattern.search(text):
+      self.ready_fn = None
+      ready_fn(self.name)
+    else:
+      self.ready_tail = text[-256:]
+
+class LoggedProcess(process.Process):
+  """ Adds the output of the process to the event log
+  """
+  def outReceived(self, data):
+    events.output(self.name, data)
+    process.Process.outReceived(self, data)
+
+class LoggedXrunProcess(process.XrunProcess):
+  """ Adds the output of the xrun process to the event log
+  """
+  def outReceived(self, data):
+    events.output(self.name, data)
+    process.XrunProcess.outReceived(self, data)
+
+class ReadyProcess(ReadinessMixin, LoggedProcess):
+  def outReceived(self, data):
+    self.check_ready(data)
+    LoggedProcess.outReceived(self, data)
+
+class ReadyXrunProcess(ReadinessMixin, LoggedXrunProcess):
+  def outReceived(self, data):
+    self.check_ready(data)
+    LoggedXrunProcess.outReceived(self, data)
+
+
+class StartupScheduler(object):
+  """ Launches processes in the order they are added with at most max_starting
+      of them not yet ready at once. A process which is not ready within the
+      ready_timeout gives up its slot so that the others are still started; the
+      checks of the test will then report the failure.
+  """
+  def __init__(self, max_starting=2, ready_timeout=15):
+    self.max_starting = max_starting
+    self.ready_timeout = ready_timeout
+    self.pending = []
+    self.starting = {}
+    self.start_time = None
+
+  def add(self, name, watched_process, ready_pattern, launch_fn, *launch_args):
+    """ Add a process to be launched by calling launch_fn(*launch_args). The
+        watched_process must be one of the Ready processes and is the one which
+        will print a line matching the ready_pattern.
+    """
+    watched_process.set_ready_pattern(ready_pattern, lambda watched_name: self.ready(name))
+    self.pending.append((name, launch_fn, launch_args))
+
+  def start(self):
+    """ Start launching processes once the reactor is running
+    """
+    reactor.callWhenRunning(self.launch_next)
+
+  def launch_next(self):
+    if self.start_time is None:
+      self.start_time = reactor.seconds()
+
+    while self.pending and len(self.starting) < self.max_starting:
+      (name, launch_fn, launch_args) = self.pending.pop(0)
+      self.starting[name] = reactor.callLater(self.ready_timeout, self.not_ready, name)
+      launch_fn(*launch_args)
+
+    if not self.pending and not self.starting:
+      log_info("All processes started in %.3f" % (reactor.seconds() - self.start_time))
+
+  def ready(self, name):
+    call = self.starting.pop(name, None)
+    if call is None:
+      return
+
+    call.cancel()
+    log_debug("%s ready after %.3f" % (name, reactor.seconds() - self.start_time))
+    self.launch_next()
+
+  def not_ready(self, name):
+    if self.starting.pop(name, None) is None:
+      return
+
+    log_warning("%s not ready after %.3f, starting the next process" % (name, self.ready_timeout))
+    self.launch_next()
@@ -1,4 +1,4 @@
-import copy
+import collections
 
 import xmos.test.base as base
 import xmos.test.xmos_logging as xmos_logging
@@ -7,20 +7,52 @@ from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
 import endpoints
 import state_rendering as rendering
 import graph
-
-class Connection(object):
-  def __init__(self, talker, listener):
-    self.talker = talker
-    self.listener = listener
+import avb_1722
+
+class InternedKey(object):
+  """ Base class for the immutable keys used to index the State. There is only ever
+      one instance per value, so the hash is computed once and comparing two keys
+      is normally an identity check.
+  """
+  __slots__ = ('_key', '_hash')
+
+  def __new__(cls, *key):
+    instance = cls._instances.get(key)
+    if instance is None:
+      instance = object.__new__(cls)
+      object.__setattr__(instance, '_key', key)
+      object.__setattr__(instance, '_hash', hash(key))
+      cls._instances[key] = instance
+    return instance
+
+  def __setattr__(self, name, value):
+    raise AttributeError("%s is immutable" % type(self).__name__)
 
   def __eq__(self, another):
-    return (hasattr(another, 'talker') and
-            hasattr(another, 'listener') and
-            self.talker == another.talker and
-            self.listener == another.listener)
+    return self is another or (type(self) is type(another) and self._key == another._key)
+
+  def __ne__(self, another):
+    return not self.__eq__(another)
 
   def __hash__(self):
-    return hash(self.__str__())
+    return self._hash
+
+  def __reduce__(self):
+    return (type(self), self._key)
+
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+
+class Connection(InternedKey):
+  __slots__ = ()
+  _instances = {}
+
+  talker = property(lambda self: self._key[0])
+  listener = property(lambda self: self._key[1])
 
   def __repr__(self):
     return "Connection(%r, %r)" % (self.talker, self.listener)
@@ -29,19 +61,12 @@ class Connection(object):
     return str(self.talker) + "->" + str(self.listener)
 
 
-class Talker(object):
-  def __init__(self, src, src_stream):
-    self.src = src
-    self.src_stream = src_stream
+class Talker(InternedKey):
+  __slots__ = ()
+  _instances = {}
 
-  def __eq__(self, another):
-    return (hasattr(another, 'src') and
-            hasattr(another, 'src_stream') and
-            self.src == another.src and
-            self.src_stream == another.src_stream)
-
-  def __hash__(self):
-    return hash(self.__str__())
+  src = property(lambda self: self._key[0])
+  src_stream = property(lambda self: self._key[1])
 
   def __repr__(self):
     return "Talker(%r, %r)" % (self.src, self.src_stream)
@@ -50,19 +75,12 @@ class Talker(object):
     return self.src + ":" + str(self.src_stream)
 
 
-class Listener(object):
-  def __init__(self, dst, dst_stream):
-    self.dst = dst
-    self.dst_stream = dst_stream
-
-  def __eq__(self, another):
-    return (hasattr(another, 'dst') and
-            hasattr(another, 'dst_stream') and
-            self.dst == another.dst and
-            self.dst_stream == another.dst_stream)
+class Listener(InternedKey):
+  __slots__ = ()
+  _instances = {}
 
-  def __hash__(self):
-    return hash(self.__str__())
+  dst = property(lambda self: self._key[0])
+  dst_stream = property(lambda self: self._key[1])
 
   def __repr__(self):
     return "Listener(%r, %r)" % (self.dst, self.dst_stream)
@@ -77,13 +95,59 @@ class State(object):
          - active_connections contains the list of connections (src:src_stream->dst:dst_stream)
          - active_talkers     contains the active talkers (src:src_stream) and the count of how may times they are used
          - active_listeners   contains the active listeners (dst:dst_stream). They can only accept one connection.
+         - port_reservations  contains the bandwidth reserved on each (node, egress port) and the count of
+                              connections of each talker stream through that port.
+         - forwarding_trees   contains, for each talker stream, the nodes which forward it to another node and
+                              the count of connections through each of their egress ports.
+        Entries are removed when their count drops to zero. The active connections are also indexed
+        by talker stream, by source node and by destination node.
+
+        A State is copied on write: a snapshot shares all of its maps with the State it was taken
+        from and a map is only copied by whichever of them first modifies it. The values stored in
+        the maps are never modified in place; they are replaced instead.
     """
+    self.shared = set()
     self.active_connections = {}
     self.active_talkers = {}
     self.active_listeners = {}
     self.talker_on_count = {}
     self.clock_source_master = {}
     self.open_relays = {}
+    self.open_relay_set = frozenset()
+    self.loops = graph.LoopTracker()
+    self.connection_paths = {}
+    self.port_reservations = {}
+    self.forwarding_trees = {}
+    self.connections_by_talker = {}
+    self.connections_by_src = {}
+    self.connections_by_dst = {}
+
+  """ The maps which are shared with snapshots until one of them is modified
+  """
+  shared_maps = ('active_connections', 'active_talkers', 'active_listeners', 'talker_on_count',
+                 'clock_source_master', 'open_relays', 'loops', 'connection_paths',
+                 'port_reservations', 'forwarding_trees', 'connections_by_talker',
+                 'connections_by_src', 'connections_by_dst')
+
+  def copy(self):
+    """ Take a snapshot of the state. This is O(1) as no maps are copied until they
+        are modified.
+    """
+    snapshot = object.__new__(State)
+    snapshot.__dict__.update(self.__dict__)
+    self.shared = set(State.shared_maps)
+    snapshot.shared = set(State.shared_maps)
+    return snapshot
+
+  def _writable(self, name):
+    """ Get a map in order to modify it, taking a private copy if it is shared
+    """
+    value = getattr(self, name)
+    if name in self.shared:
+      self.shared.remove(name)
+      value = value.copy()
+      setattr(self, name, value)
+    return value
 
   def dump(self):
     log_debug("State:")
@@ -98,6 +162,7 @@ class State(object):
     for c,n in self.clock_source_master.iteritems():
       if n:
         log_debug("Clock source master %s" % c)
+    self.dump_port_reservations()
 
     rendering.draw_state(self, sorted(endpoints.get_all().keys()))
 
@@ -111,7 +176,8 @@ class State(object):
       return
 
     # If it is a self-connect the talker will still be made ready
-    self.talker_on_count[src] = self.talker_on_count.get(src, 0) + 1
+    talker_on_count = self._writable('talker_on_count')
+    talker_on_count[src] = talker_on_count.get(src, 0) + 1
 
     if src == dst:
       return
@@ -124,9 +190,19 @@ class State(object):
     listener = Listener(dst, dst_stream)
     connection = Connection(talker, listener)
 
-    self.active_talkers[talker] = self.active_talkers.get(talker, 0) + 1
-    self.active_listeners[listener] = 1 # Listeners can only accept one connection
-    self.active_connections[connection] = self.active_connections.get(connection, 0) + 1
+    active_talkers = self._writable('active_talkers')
+    active_talkers[talker] = active_talkers.get(talker, 0) + 1
+    self._writable('active_listeners')[listener] = 1 # Listeners can only accept one connection
+    active_connections = self._writable('active_connections')
+    active_connections[connection] = active_connections.get(connection, 0) + 1
+    self._writable('loops').add_connection(src, dst)
+
+    self._index('connections_by_talker', talker, connection)
+    self._index('connections_by_src', src, connection)
+    self._index('connections_by_dst', dst, connection)
+
+    self._writable('connection_paths')[connection] = path
+    self.update_path(talker, path, 1)
 
   def disconnect(self, src, src_stream, dst, dst_stream):
     if not self.connected(src, src_stream, dst, dst_stream):
@@ -136,39 +212,159 @@ class State(object):
     listener = Listener(dst, dst_stream)
     connection = Connection(talker, listener)
 
-    assert self.active_talkers.get(talker, 0)
-    self.active_talkers[talker] -= 1
+    self._decrement('active_talkers', talker)
+    self._decrement('active_listeners', listener)
+    self._writable('loops').remove_connection(src, dst)
 
-    assert self.active_listeners.get(listener, 0)
-    self.active_listeners[listener] -= 1
+    if not self._decrement('active_connections', connection):
+      self._unindex('connections_by_talker', talker, connection)
+      self._unindex('connections_by_src', src, connection)
+      self._unindex('connections_by_dst', dst, connection)
+      self.update_path(talker, self._writable('connection_paths').pop(connection), -1)
 
-    assert self.active_connections.get(connection, 0)
-    self.active_connections[connection] -= 1
+  def _decrement(self, name, key):
+    """ Decrement a count, removing the entry when it reaches zero
+    """
+    counts = self._writable(name)
+    assert counts.get(key, 0)
+    count = counts[key] - 1
+    if count:
+      counts[key] = count
+    else:
+      del counts[key]
+    return count
+
+  def _index(self, name, key, connection):
+    index = self._writable(name)
+    index[key] = index.get(key, frozenset()) | frozenset([connection])
+
+  def _unindex(self, name, key, connection):
+    index = self._writable(name)
+    connections = index[key] - frozenset([connection])
+    if connections:
+      index[key] = connections
+    else:
+      del index[key]
 
   def connected(self, src, src_stream, dst, dst_stream=None):
     """ Check whether a src stream is connected to a dest node. Can specify the
         dest stream if desired.
     """
     talker = Talker(src, src_stream)
-    listener = Listener(dst, dst_stream)
-    connected = False
-    if dst_stream:
-      connection = Connection(talker, listener)
-      if self.active_connections.get(connection, 0):
-          connected = True
+    if dst_stream is not None:
+      connection = Connection(talker, Listener(dst, dst_stream))
+      connected = connection in self.active_connections
 
     else:
-      for c,n in self.active_connections.iteritems():
-        if not n:
-          continue
-
-        if c.talker == talker and c.listener.dst == dst:
-          connected = True
+      connected = any(c.talker is talker for c in self.connections_by_dst.get(dst, ()))
 
     # Note that the format of each operand is %s because that copes with a None
     log_debug("connected %s %s %s %s ? %s" % (src, src_stream, dst, dst_stream, connected))
     return connected
 
+  def update_path(self, talker, path, change):
+    """ Update the reservations on every endpoint egress port in a path and the
+        forwarding tree of the talker stream. Each talker stream is only reserved
+        once on a port, no matter how many connections of it are forwarded through
+        that port.
+    """
+    reservations = self._writable('port_reservations')
+    trees = self._writable('forwarding_trees')
+    tree = dict(trees.get(talker, {}))
+
+    for index,node in enumerate(path[:-1]):
+      if not endpoints.get(node):
+        continue
+
+      # The port ID is the last character of the port name
+      port = int(path[index + 1][-1])
+      reservation = reservations.get((node, port), { 'bandwidth' : 0, 'streams' : {} })
+      bandwidth = reservation['bandwidth']
+      streams = dict(reservation['streams'])
+      previous = streams.get(talker, 0)
+      count = previous + change
+
+      if not previous or not count:
+        # The stream is being added to or removed from this port. A bridge must
+        # reserve an extra byte per packet.
+        is_bridge = node != talker.src
+        stream_bandwidth = avb_1722.calculate_stream_bandwidth(talker, is_bridge)
+        bandwidth += stream_bandwidth if count else -stream_bandwidth
+
+      if count:
+        streams[talker] = count
+      else:
+        del streams[talker]
+
+      if streams:
+        reservations[(node, port)] = { 'bandwidth' : bandwidth, 'streams' : streams }
+      else:
+        del reservations[(node, port)]
+
+      if index == 0:
+        # The talker itself is the root of the tree rather than a forwarding node
+        continue
+
+      ports = dict(tree.get(node, {}))
+      ports[port] = ports.get(port, 0) + change
+      if not ports[port]:
+        del ports[port]
+
+      if ports:
+        tree[node] = ports
+      else:
+        del tree[node]
+
+    if tree:
+      trees[talker] = tree
+    else:
+      trees.pop(talker, None)
+
+  def get_forwarding_nodes(self, src, src_stream):
+    """ The nodes which forward a talker stream and the ports they forward it on
+    """
+    return self.forwarding_trees.get(Talker(src, src_stream), {})
+
+  def get_forwarding_count(self, src, src_stream, node):
+    """ The number of connections of a talker stream that a node is forwarding
+    """
+    return sum(self.get_forwarding_nodes(src, src_stream).get(node, {}).values())
+
+  def get_port_bandwidth(self, node, port):
+    reservation = self.port_reservations.get((node, port))
+    if reservation is None:
+      return 0
+    return reservation['bandwidth']
+
+  def get_port_stream_count(self, node, port, src, src_stream):
+    """ The number of connections of a talker stream that are forwarded through a port
+    """
+    reservation = self.port_reservations.get((node, port))
+    if reservation is None:
+      return 0
+    return reservation['streams'].get(Talker(src, src_stream), 0)
+
+  def dump_port_reservations(self):
+    for (node, port) in sorted(self.port_reservations.keys()):
+      reservation = self.port_reservations[(node, port)]
+      log_debug("%s port %d shaper bandwidth %d (%s)" % (node, port, reservation['bandwidth'],
+            ", ".join(sorted(str(t) for t in reservation['streams']))))
+
+  def get_connections_from(self, src):
+    """ The active connections whose talker is on the given node
+    """
+    return self.connections_by_src.get(src, frozenset())
+
+  def get_connections_to(self, dst):
+    """ The active connections whose listener is on the given node
+    """
+    return self.connections_by_dst.get(dst, frozenset())
+
+  def get_connections_of(self, src, src_stream):
+    """ The active connections of a talker stream
+    """
+    return self.connections_by_talker.get(Talker(src, src_stream), frozenset())
+
   def talker_active_count(self, src, src_stream):
     talker = Talker(src, src_stream)
     return self.active_talkers.get(talker, 0)
@@ -277,24 +473,60 @@ class State(object):
     return self.clock_source_master.get(node, 0)
 
   def set_clock_source_master(self, node):
-    self.clock_source_master[node] = 1
+    self._writable('clock_source_master')[node] = 1
 
   def set_clock_source_slave(self, node):
-    self.clock_source_master[node] = 0
+    self._writable('clock_source_master')[node] = 0
 
   def set_relay_open(self, node):
-    self.open_relays[node] = 1
+    self._writable('open_relays')[node] = 1
+    self.open_relay_set = self.open_relay_set | set([node])
+    self.reroute()
 
   def set_relay_closed(self, node):
-    self.open_relays[node] = 0
+    self._writable('open_relays')[node] = 0
+    self.open_relay_set = self.open_relay_set - set([node])
+    self.reroute()
+
+  def reroute(self):
+    """ Move connections onto the shortest path for the current set of open relays.
+        A connection with no path left keeps its old path and its reservations. The
+        only connections left without a path are either disconnected in the same
+        step (link_down) or restored by closing the relay again (link_downup), which
+        is too quick for the devices to change their shapers. Releasing them here
+        would expect shaper changes the devices never make, whereas keeping them
+        expects none, as before the reservations were tracked.
+    """
+    for connection,path in self.connection_paths.items():
+      new_path = graph.find_path(self, connection.talker.src, connection.listener.dst)
+      if new_path and new_path != path:
+        self.update_path(connection.talker, path, -1)
+        self.update_path(connection.talker, new_path, 1)
+        self._writable('connection_paths')[connection] = new_path
 
   def is_relay_open(self, node):
     return self.open_relays.get(node, 0)
 
+  def get_open_relays(self):
+    """ The set of open relays. This is used as the key to the route tables so only
+        changes when a relay is opened or closed.
+    """
+    return self.open_relay_set
+
+# The values of descriptor items which are taken from the state (descriptor elements
+# of type 'state') and the functions that read them for a given node
+state_accessors = {
+  'clock_source_index' : State.get_clock_source_index,
+}
+
 # Global state variables (not to be accessed directly)
 _current = State()
 _next = State()
 
+# Previous states, kept for debugging. Snapshots only hold the maps that changed
+# in each step so are cheap to keep.
+_history = collections.deque(maxlen=0)
+
 
 # Access functions
 def get_current():
@@ -303,9 +535,30 @@ def get_current():
 def get_next():
   return _next
 
+def get_history():
+  return list(_history)
+
+def set_history_length(length):
+  """ Set how many previous states to keep. None keeps all of them.
+  """
+  global _history
+  _history = collections.deque(_history, maxlen=length)
+
+def reset(talker_on_count=None):
+  """ Return to the initial state with no connections. The talkers which have been
+      turned on can be kept, as devices which are not reloaded remember them.
+  """
+  global _next
+  global _current
+  _current = State()
+  if talker_on_count:
+    _current.talker_on_count = dict(talker_on_count)
+  _next = _current.copy()
+  _history.clear()
+
 def move_next_to_current():
   global _next
   global _current
+  _history.append(_current)
   _current = _next
-  _next = copy.deepcopy(_current)
-
+  _next = _current.copy()
@@ -29,16 +29,11 @@ def non_connection_line(ep_names, active_talkers):
   return line
 
 def get_listeners_for_talker(s, talker):
-  listeners = []
-  for c,n in s.active_connections.iteritems():
-    if n and c.talker.src == talker:
-      listeners += [c.listener.dst]
-  return listeners
+  return [c.listener.dst for c in s.get_connections_from(talker)]
 
 def get_talker_for_listener(s, listener):
-  for c,n in s.active_connections.iteritems():
-    if n and c.listener.dst == listener:
-      return c.talker.src
+  for c in s.get_connections_to(listener):
+    return c.talker.src
   return None
 
 def get_max_listener_index(s, ep_names, talker):
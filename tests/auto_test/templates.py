@@ -0,0 +1,116 @@
+""" Expected sequence templates.
+
+    The expectation classes here behave exactly like the ones from the test framework
+    but record the arguments they were created with. A tree of them can then be kept
+    as a template and a fresh copy of the tree created each time it is needed, which
+    is much cheaper than working out all the expected messages again.
+"""
+import collections
+
+import xmos.test.base as base
+from xmos.test.xmos_logging import log_debug
+
+import events
+import latency
+
+# Each Expected is given an id so that its match can be found in the event log
+next_expected_id = 0
+
+class Expected(base.Expected):
+  """ Also records the latency to the expected message being matched and adds the
+      match to the event log. The completion function is wrapped to do this, so the
+      arguments recorded for the template are the ones originally given.
+  """
+  def __init__(self, *args, **kwargs):
+    global next_expected_id
+    self.expected_id = next_expected_id
+    next_expected_id += 1
+    self.template_args = (args, kwargs)
+    self.kind = latency.current_kind
+    self.step = latency.current_step
+    self.completion_fn = kwargs.get('completionFn')
+    base.Expected.__init__(self, *args, **dict(kwargs, completionFn=self.matched))
+
+  def matched(self, expected):
+    (process, pattern) = self.template_args[0][:2]
+    latency.matched(self.kind, self.step, process, pattern)
+    events.matched(self.expected_id, self.kind, process, pattern)
+    if self.completion_fn is not None:
+      self.completion_fn(expected)
+
+class AllOf(base.AllOf):
+  def __init__(self, *args, **kwargs):
+    self.template_args = (args, kwargs)
+    base.AllOf.__init__(self, *args, **kwargs)
+
+class OneOf(base.OneOf):
+  def __init__(self, *args, **kwargs):
+    self.template_args = (args, kwargs)
+    base.OneOf.__init__(self, *args, **kwargs)
+
+class NoneOf(base.NoneOf):
+  def __init__(self, *args, **kwargs):
+    self.template_args = (args, kwargs)
+    base.NoneOf.__init__(self, *args, **kwargs)
+
+class Sequence(base.Sequence):
+  def __init__(self, *args, **kwargs):
+    self.template_args = (args, kwargs)
+    base.Sequence.__init__(self, *args, **kwargs)
+
+def instantiate(template):
+  """ Create a new copy of a template. Lists and expectations are copied, anything
+      else (patterns, timeouts, completion functions and their arguments) is shared.
+  """
+  if isinstance(template, list):
+    return [instantiate(t) for t in template]
+
+  if isinstance(template, tuple):
+    return tuple(instantiate(t) for t in template)
+
+  template_args = getattr(template, 'template_args', None)
+  if template_args is None:
+    return template
+
+  (args, kwargs) = template_args
+  copy = type(template)(*[instantiate(a) for a in args], **kwargs)
+  if isinstance(template, Expected):
+    copy.kind = template.kind
+  return copy
+
+
+class TemplateCache(object):
+  """ A least-recently-used cache of templates. The values stored are never handed
+      out, only copies of them, so that the cached trees are not changed by the
+      master as it matches them.
+  """
+  def __init__(self, name, max_size):
+    self.name = name
+    self.max_size = max_size
+    self.templates = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, build_fn, *args):
+    """ Get a copy of the template for the key, calling build_fn(*args) to create
+        the template if it is not in the cache.
+    """
+    template = self.templates.pop(key, None)
+    if template is None:
+      self.misses += 1
+      template = build_fn(*args)
+      if len(self.templates) >= self.max_size:
+        self.templates.popitem(last=False)
+    else:
+      self.hits += 1
+
+    # Re-insert to make this the most recently used
+    self.templates[key] = template
+    return instantiate(template)
+
+  def clear(self):
+    self.templates.clear()
+
+  def dump(self):
+    log_debug("%s templates: %d cached, %d hits, %d misses" %
+        (self.name, len(self.templates), self.hits, self.misses))
@@ -2,10 +2,15 @@ import getpass
 import json
 import os
 import random
-import re
 import sys
 import time
 
+# Replaying a recorded run or running with simulated devices can use a virtual clock,
+# which has to be installed before the reactor is imported
+import virtual_time
+if virtual_time.option_given(sys.argv, '--replay') or virtual_time.option_given(sys.argv, '--virtual-time'):
+  virtual_time.install()
+
 from twisted.internet import reactor, defer
 from twisted.internet.defer import inlineCallbacks
 
@@ -20,54 +25,73 @@ from xmos.test.base import AllOf, OneOf, NoneOf, Sequence, Expected, getActivePr
 from xmos.test.xmos_logging import log_error, log_warning, log_info, log_debug
 
 from actions import *
+import controller
 import sequences
 import endpoints
 import generators
 import analyzers
 import graph
+import events
+import latency
+import replay
+import standin
+import startup
 
 class ControllerProcess(Process):
   def __init__(self, name, master, controllerType='python', **kwargs):
     Process.__init__(self, name, master, **kwargs)
     self.controllerType = controllerType
-    self.discover_active = False
-    self.entities = {}
+    self.parser = controller.ControllerOutputParser(controllerType, clock=reactor.seconds)
+    self.waits = []
 
-  def outReceived(self, data):
-    if self.controllerType == 'python':
-      m = re.search("Found \d+ entities", data)
-      if m:
-        self.entities.clear()
-        lines = data.split()
-        for line in lines:
-          if line.startswith("0x"):
-            try:
-              self.entities[int(line, 16)] = 1
-            except Exception, e:
-              pass
-    else:
-      if not self.discover_active:
-        m = re.search("End Station  |  Name                  |  Entity GUID         |  MAC", data)
-        if m:
-          self.discover_active = True
-        self.entities.clear()
-
-      if self.discover_active:
-        lines = data.split('\n')
-        for line in lines:
-          if line.startswith('C - End Station'):
-            self.discover_active = False
-            break
-
-          if line.startswith('C '):
-            try:
-              guid = line.split('|')[2].strip()
-              self.entities[int(guid, 16)] = 1
-            except Exception, e:
-              pass
+  @property
+  def entities(self):
+    """ The entities seen in the last listing, mapped to the time they were seen
+    """
+    return self.parser.entities
 
+  def outReceived(self, data):
+    events.output(self.name, data)
+    self.parser.data_received(data)
+    self.check_waits()
     Process.outReceived(self, data)
 
+  def wait_for(self, condition, timeout):
+    """ Returns a Deferred which fires with True as soon as the condition is met by
+        the controller output, or False if it is not met within the timeout.
+    """
+    d = defer.Deferred()
+    if condition():
+      d.callback(True)
+    else:
+      wait = [condition, d, None]
+      wait[2] = reactor.callLater(timeout, self.wait_timeout, wait)
+      self.waits.append(wait)
+    return d
+
+  def wait_timeout(self, wait):
+    self.waits.remove(wait)
+    wait[1].callback(False)
+
+  def check_waits(self):
+    for wait in list(self.waits):
+      (condition, d, call) = wait
+      if condition():
+        self.waits.remove(wait)
+        call.cancel()
+        d.callback(True)
+
+  def wait_for_entities_available(self, guids, timeout):
+    """ Wait until exactly the entities given have been notified as available
+    """
+    return self.wait_for(lambda: set(self.parser.available.keys()) == guids, timeout)
+
+  def wait_for_listing(self, timeout):
+    """ Wait for the next listing of entities to be completed
+    """
+    listings_completed = self.parser.listings_completed
+    return self.wait_for(lambda: self.parser.listings_completed > listings_completed, timeout)
+
 
 # Assign the xrun variable used to start processes
 exe_name = base.exe_name('xrun')
@@ -78,14 +102,22 @@ def print_comment(test_step):
   if comment is not None:
     log_info("\n>> %s\n" % comment)
 
-def configure_analyzers():
-  """ Ensure the analyzers have started properly and then configure their channel
-      frequencies as specified in the test configuration file
+def check_device_startup():
+  """ Ensure the analyzers and generators have started properly
   """
-  analyzer_startup = [Expected(a, "connected to .*: %d" % analyzers.get_port(a), 15, critical=True)
-                        for a in analyzers.get_all()]
-  yield master.expect(AllOf(analyzer_startup))
+  device_startup = [Expected(a, "connected to .*: %d" % analyzers.get_port(a), 15, critical=True)
+                      for a in analyzers.get_all()]
+  device_startup += [Expected(g, "connected to .*: %d" % generators.get_port(g), 15, critical=True)
+                      for g in generators.get_all()]
+  yield master.expect(AllOf(device_startup))
 
+def configure_analyzers():
+  """ Configure the channel frequencies of the analyzers as specified in the test
+      configuration file. All the commands are sent to each analyzer without waiting
+      and the expected responses are returned so that all devices can be checked
+      together.
+  """
+  expected = []
   for (name,analyzer) in analyzers.get_all().iteritems():
     if analyzer['type'] != 'audio':
       continue
@@ -94,34 +126,36 @@ def configure_analyzers():
 
     # Disable all channels
     master.sendLine(name, "d a")
-    yield master.expect(Expected(name, "Channel 0: disabled", 15))
 
     # Set the base channel index
     analyzer_base = analyzer['base']
     master.sendLine(name, "b %d" % analyzer_base)
 
     # Configure all channels
+    sine_tables = []
     for (chan_id,freq) in analyzer['frequencies'].iteritems():
       # Need to convert unicode to string before sending as a command
       chan = int(chan_id)
       master.sendLine(name, "c %d %d" % (chan, freq))
 
       # The channel ID is offset from the base in the generating message
-      yield master.expect(
-          Expected(name, "Generating sine table for chan %d" % (chan - analyzer_base), 15))
+      sine_tables.append(Expected(name, "Generating sine table for chan %d" % (chan - analyzer_base), 15))
 
     master.sendLine(name, "e a")
     channel_enables = [Expected(name, "Channel %d: enabled" % (int(c) - analyzer_base), 15)
                         for c in analyzer['frequencies'].keys()]
-    yield master.expect(AllOf(channel_enables))
+
+    # The commands are processed in order by each analyzer
+    expected.append(Sequence([Expected(name, "Channel 0: disabled", 15),
+                              AllOf(sine_tables),
+                              AllOf(channel_enables)]))
+  return expected
 
 def configure_generators():
-  """ Ensure the generators have started properly
+  """ Configure the traffic of the generators. The expected responses are returned
+      so that all devices can be checked together.
   """
-  generator_startup = [Expected(a, "connected to .*: %d" % generators.get_port(a), 15, critical=True)
-                        for a in generators.get_all()]
-  yield master.expect(AllOf(generator_startup))
-
+  expected = []
   for (name,generator) in generators.get_all().iteritems():
     log_info("Configure %s" % name)
 
@@ -135,7 +169,8 @@ def configure_generators():
 
     # Apply the specified config
     master.sendLine(name, "p")
-    yield master.expect(Expected(name, "Current configuration", 5))
+    expected.append(Expected(name, "Current configuration", 5))
+  return expected
 
 def ptp_startup_two_port(e, grandmaster, user):
   """ Determine the PTP sequence for the node. If it is not the grandmaster
@@ -194,25 +229,63 @@ def check_endpoint_startup():
   yield master.expect(AllOf(ptp_startup + maap))
 
 
-@inlineCallbacks
-def runTest(args):
-  """ The test program - needs to yield on each expect and be decorated
-    with @inlineCallbacks
+def reset_rig(args):
+  """ Return the devices to the state they are in after startup so that another test
+      can be run without reloading them. Relays are closed, every connection in the
+      model is disconnected (which also returns the clock sources to their defaults)
+      and the traffic generators are silenced.
   """
-  for y in configure_generators():
-    yield y
+  print_title("Reset rig")
+  state.move_next_to_current()
 
-  for y in configure_analyzers():
-    yield y
+  expected = []
+  for relay in sorted(state.get_current().get_open_relays()):
+    for y in action_link_up(args, generator.Command("link_up %s" % relay), expected, [relay]):
+      yield y
+    state.move_next_to_current()
 
-  for y in check_endpoint_startup():
-    yield y
+  connections = state.get_current().active_connections.keys()
+  for c in sorted(connections, key=lambda c: (c.talker.src, c.talker.src_stream, c.listener.dst, c.listener.dst_stream)):
+    params = [c.talker.src, str(c.talker.src_stream), c.listener.dst, str(c.listener.dst_stream)]
+    expected = []
+    for y in action_disconnect(args, generator.Command("disconnect %s" % ' '.join(params)), expected, params):
+      yield y
+    state.move_next_to_current()
+
+    if expected:
+      master.addExpected(AllOf(expected))
+      master.startNext()
+      yield master.expect()
+
+  for name in generators.get_all():
+    master.sendLine(name, "m s")
+
+  # Start the next test from a clean model. The talkers are not reloaded, so they
+  # will not report being ready again.
+  state.reset(state.get_current().talker_on_count)
+  sequences.get_and_clear_final_port_shaper_states()
+
+  for process in getActiveProcesses():
+    master.clearExpectHistory(process)
+
+def run_test_steps(args, test_name, test_config):
+  """ Run all the steps of one test
+  """
+  print_title("Test: %s" % test_name)
+
+  # Need to set the seed before reading the test_steps as it uses random
+  set_seed(args, test_config)
+
+  # Read the test file into class structure
+  with open_json(test_name) as f:
+    test_steps = json.load(f, object_hook=generator.json_hooks)
 
   expected = []
   for y in action_discover(args, generator.Command("discover"), expected, []):
     yield y
 
   check_num = 1
+  step_num = 0
   for test_step in test_steps:
     print_comment(test_step)
     state.move_next_to_current()
@@ -221,8 +294,12 @@ def runTest(args):
     if command is None:
       continue
 
+    step_num += 1
+    latency.start_step(test_name, step_num, command)
+    events.step(test_name, step_num, command)
+
     action = command.split(' ')
-    action_function = eval('action_%s' % action[0])
+    action_function = get_action_function(action[0])
     expected = []
     for y in action_function(args, test_step, expected, action[1:]):
       yield y
@@ -231,8 +308,12 @@ def runTest(args):
 
     if (test_step.checkpoint or test_step.checkpoint is None) and args.master.nextExpected:
       print_title("Check: %d" % check_num)
+      events.check(test_name, check_num)
       check_num += 1
 
+      # Record the shaper bandwidth the model expects each port to have reserved
+      state.get_next().dump_port_reservations()
+
       args.master.startNext()
       yield args.master.expect()
 
@@ -240,6 +321,73 @@ def runTest(args):
       for process in getActiveProcesses():
         master.clearExpectHistory(process)
 
+def can_continue_session(args, test_name, test_config, firmware_hash):
+  """ A test can only reuse the running devices if they are running the current
+      firmware and the test does not need different analyzer types.
+  """
+  if endpoints.get_firmware_hash(rootDir) != firmware_hash:
+    log_warning("Endpoint firmware has changed, %s needs a new session" % test_name)
+    return False
+
+  if test_config.get('types', {}) != args.test_configs[0].get('types', {}):
+    log_warning("%s uses different analyzer types, it needs a new session" % test_name)
+    return False
+
+  return True
+
+def write_session_results(args, completed, test_events, finished):
+  """ Record which tests were run so that any remaining ones can be run in a new session.
+      This is written after each test so that a session which stops part way through
+      still shows which tests it completed. The range of events of each test in the
+      event log is included so that the output of one test can be found.
+  """
+  remaining = [t for t in args.test if t not in completed]
+  with open(os.path.join(args.logdir, 'session.json'), 'w') as f:
+    json.dump({'completed' : completed, 'remaining' : remaining,
+               'events' : test_events, 'finished' : finished}, f, indent=2)
+
+@inlineCallbacks
+def runTest(args):
+  """ The test program - needs to yield on each expect and be decorated
+    with @inlineCallbacks. When more than one test is given they are all run in
+    one session, keeping the devices running between the tests.
+  """
+  for y in check_device_startup():
+    yield y
+
+  # Configure all the devices at once
+  device_configuration = configure_generators() + configure_analyzers()
+  if device_configuration:
+    yield master.expect(AllOf(device_configuration))
+
+  for y in check_endpoint_startup():
+    yield y
+
+  firmware_hash = endpoints.get_firmware_hash(rootDir)
+  completed = []
+  test_events = {}
+  for (test_name, test_config) in zip(args.test, args.test_configs):
+    if completed:
+      if not can_continue_session(args, test_name, test_config, firmware_hash):
+        break
+
+      for y in reset_rig(args):
+        yield y
+
+    first_event = events.test_start(test_name)
+    for y in run_test_steps(args, test_name, test_config):
+      yield y
+    test_events[test_name] = [first_event, events.test_end(test_name)]
+    completed.append(test_name)
+    write_session_results(args, completed, test_events, False)
+
+  write_session_results(args, completed, test_events, True)
+  if args.replayer:
+    args.replayer.report()
+  if args.virtual_time:
+    log_info("Virtual clock reached %.3f in %d jumps after %.3f of real time" %
+        (reactor.seconds(), reactor.jumps, time.time() - reactor.real_start))
+
   # Allow everything time to settle (in case an error is being generated)
   yield base.sleep(5)
   base.testComplete(reactor)
@@ -281,13 +429,29 @@ if __name__ == "__main__":
   parser.add_argument('--config', nargs='?', help="name of .json file", required=True)
   parser.add_argument('--user', nargs='?', help="username (selects board setup from json config file)", default=getpass.getuser())
   parser.add_argument('--seed', type=int, nargs='?', help="random seed", default=None)
-  parser.add_argument('--test', nargs='?', help="name of .json test configuration file", required=True)
+  parser.add_argument('--test', nargs='+', help="name of .json test configuration file(s), run in one session", required=True)
   parser.add_argument('--logdir', nargs='?', help="folder to write all log files to", default="logs")
   parser.add_argument('--types', nargs='*', help="override the types of devices", default="")
   parser.add_argument('--controller-type', choices=['c', 'python'], help="controller type", default='c')
   parser.add_argument('-s', '--stop-on-error', action='store_true', help="set errors to be fatal")
+  parser.add_argument('--startup-concurrency', type=int, nargs='?', help="maximum number of processes starting at once", default=2)
+  parser.add_argument('--replay', help="folder of a previous run to replay instead of running the devices", default=None)
+  parser.add_argument('--virtual-time', action='store_true', help="run on a virtual clock (only with --standin or --replay)")
+  parser.add_argument('--standin', action='store_true', help="use stand-ins instead of the devices")
+  parser.add_argument('--standin-jitter', type=int, nargs='?', help="maximum random delay in milliseconds added to each line from the stand-ins", default=50)
   args = parser.parse_args()
 
+  # The virtual clock has already been installed if --replay was given at all
+  if args.replay is not None and not args.replay:
+    parser.error("--replay needs the folder of the run to replay")
+
+  if args.standin and args.replay:
+    parser.error("--standin and --replay cannot be used together")
+
+  # Real devices do not follow the virtual clock, so the results would be meaningless
+  if args.virtual_time and not args.replay and not args.standin:
+    parser.error("--virtual-time can only be used with --standin or --replay")
+
   if args.stop_on_error:
     base.defaultToCriticalFailure = True
 
@@ -298,21 +462,51 @@ if __name__ == "__main__":
       filename=os.path.join(args.logdir, args.logfile),
       summary_filename=args.summaryfile)
 
-  args.eth_id = get_eth_id(args)
+  if args.replay:
+    if os.path.abspath(args.replay) == os.path.abspath(args.logdir):
+      log_error("Cannot replay into the folder being replayed")
+      sys.exit(1)
 
-  with open_json(args.config) as f:
-    config = json.load(f)
+    # The processes are connected to the recording instead of being launched
+    args.replayer = replay.Replayer(args.replay)
+    startup.set_spawn_function(args.replayer.spawn)
+  else:
+    args.replayer = None
 
-  # Read the test file into a standard Python data structure
-  with open_json(args.test) as f:
-    test_config = json.load(f)
+  if args.replay or args.standin:
+    args.eth_id = None
+  else:
+    args.eth_id = get_eth_id(args)
 
-  # Need to set the seed before reading the test_steps as it uses random
-  set_seed(args, test_config)
+  with open_json(args.config) as f:
+    config = json.load(f)
 
-  # Read the test file into class structure
-  with open_json(args.test) as f:
-    test_steps = json.load(f, object_hook=generator.json_hooks)
+  if args.standin:
+    # The processes are connected to the stand-ins instead of being launched
+    hub = standin.StandinHub(args, config['controller']['name'],
+        jitter=args.standin_jitter / 1000.0, seed=args.seed or 1)
+    startup.set_spawn_function(hub.spawn)
+
+  # Read the test files into standard Python data structures and report any
+  # unknown commands before starting anything
+  args.test_configs = []
+  for test_name in args.test:
+    with open_json(test_name) as f:
+      test_config = json.load(f)
+    check_test_config(test_config)
+    args.test_configs.append(test_config)
+
+  # Measure latencies and log events on a monotonic clock so that setting the system
+  # time does not change them, unless everything is running on the virtual clock
+  if isinstance(reactor, virtual_time.VirtualTimeReactor):
+    clock = reactor.seconds
+  else:
+    clock = events.monotonic
+  latency.set_clock(clock)
+  events.open_log(os.path.join(args.logdir, 'events.jsonl'), clock)
+  reactor.addSystemEventTrigger('after', 'shutdown', events.close_log)
+  reactor.addSystemEventTrigger('after', 'shutdown', latency.write,
+      os.path.join(args.logdir, 'latency.json'))
 
   # Create the master to pass to each process
   master = xmos.test.master.Master()
@@ -321,9 +515,12 @@ if __name__ == "__main__":
   # Store the connectivity so that paths between nodes can be determined
   graph.set_connections(config['port_connections'])
 
-  delay = generators.start(rootDir, args, master, config['generators'], 0)
-  delay = analyzers.start(rootDir, args, master, config['analyzers'], test_config, delay)
-  delay = endpoints.start(rootDir, args, master, config['endpoints'], delay)
+  # Launch the processes, each one waiting for a free slot
+  scheduler = startup.StartupScheduler(args.startup_concurrency)
+  generators.start(rootDir, args, master, config['generators'], scheduler)
+  analyzers.start(rootDir, args, master, config['analyzers'], args.test_configs[0], scheduler)
+  endpoints.start(rootDir, args, master, config['endpoints'], scheduler)
+  scheduler.start()
 
   # Create a controller process to send AVB commands to
   controller_id = config['controller']['name']
@@ -332,20 +529,20 @@ if __name__ == "__main__":
   args.controller_id = controller_id
 
   if args.controller_type == 'c':
-    controller = ControllerProcess(controller_id, master, controllerType=args.controller_type,
+    controller_process = ControllerProcess(controller_id, master, controllerType=args.controller_type,
         output_file=os.path.join(args.logdir, controller_id + '.log'), send_new_line='\n')
 
     # Call c-based controller
     controller_bin = os.path.join(rootDir, 'avdecc-lib', 'controller', 'app', 'cmdline', 'avdecccmdline')
-    reactor.spawnProcess(controller, controller_bin, [controller_bin, '-t', '-i', args.eth_id], env=os.environ, path=args.logdir)
+    startup.spawn_process(controller_process, controller_bin, [controller_bin, '-t', '-i', args.eth_id], env=os.environ, path=args.logdir)
 
   else:
-    controller = ControllerProcess(controller_id, master, controllerType=args.controller_type,
+    controller_process = ControllerProcess(controller_id, master, controllerType=args.controller_type,
         output_file=os.path.join(args.logdir, controller_id + '.log'))
 
     # Call python with unbuffered mode to enable us to see each line as it happens
     controller_dir = os.path.join(rootDir, 'appsval_avb', 'controller', 'avb')
-    reactor.spawnProcess(controller, sys.executable, [sys.executable, '-u', 'controller.py', '--batch', '--test-mode', '-i', args.eth_id],
+    startup.spawn_process(controller_process, sys.executable, [sys.executable, '-u', 'controller.py', '--batch', '--test-mode', '-i', args.eth_id],
         env=os.environ, path=controller_dir)
 
   base.testStart(runTest, args)
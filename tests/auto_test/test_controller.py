@@ -0,0 +1,78 @@
+""" Tests of the parsing of the controller output. Run with:
+
+      python -m unittest test_controller
+"""
+import unittest
+
+import controller
+
+C_HEADER = "End Station  |  Name                  |  Entity GUID         |  MAC"
+
+class PythonControllerTest(unittest.TestCase):
+  def setUp(self):
+    self.parser = controller.ControllerOutputParser('python', clock=lambda: 0)
+
+  def test_listing(self):
+    self.parser.data_received("Found 2 entities\n0x0001  dc0\n0x0002  dc1\n")
+    self.assertEqual(sorted(self.parser.entities), [1, 2])
+    self.assertEqual(self.parser.state, controller.IDLE)
+    self.assertEqual(self.parser.listings_completed, 1)
+
+  def test_lines_split_across_chunks(self):
+    for chunk in ["Found 2 ent", "ities\n0x00", "01  dc0\n0x0002  dc1", "\n"]:
+      self.parser.data_received(chunk)
+    self.assertEqual(sorted(self.parser.entities), [1, 2])
+    self.assertEqual(self.parser.listings_completed, 1)
+
+  def test_decoration_is_skipped(self):
+    self.parser.data_received("Found 2 entities\nEntity GUID  Name\n------------\n"
+                              "0xzz\n0x0001  dc0\n\n0x0002  dc1\n")
+    self.assertEqual(sorted(self.parser.entities), [1, 2])
+    self.assertEqual(self.parser.listings_completed, 1)
+
+  def test_guid_not_in_first_column(self):
+    self.parser.data_received("Found 2 entities\n  0: 0x0001  dc0\n  1: 0x0002  dc1\n")
+    self.assertEqual(sorted(self.parser.entities), [1, 2])
+    self.assertEqual(self.parser.state, controller.IDLE)
+
+  def test_no_entities(self):
+    self.parser.data_received("Found 0 entities\n0x0001  dc0\n")
+    self.assertEqual(self.parser.entities, {})
+    self.assertEqual(self.parser.listings_completed, 1)
+
+  def test_new_listing_replaces_old(self):
+    self.parser.data_received("Found 2 entities\n0x0001  dc0\n0x0002  dc1\n")
+    self.parser.data_received("Found 1 entities\n0x0003  dc2\n")
+    self.assertEqual(sorted(self.parser.entities), [3])
+    self.assertEqual(self.parser.listings_completed, 2)
+
+class CControllerTest(unittest.TestCase):
+  def setUp(self):
+    self.parser = controller.ControllerOutputParser('c', clock=lambda: 0)
+
+  def test_listing(self):
+    self.parser.data_received("%s\n"
+        "C  0  |  dc0                   |  0x0000000000000001  |  00:22:97:00:00:01\n"
+        "C  1  |  dc1                   |  0x0000000000000002  |  00:22:97:00:00:02\n"
+        "C - End Station list complete\n" % C_HEADER)
+    self.assertEqual(sorted(self.parser.entities), [1, 2])
+    self.assertEqual(self.parser.state, controller.IDLE)
+    self.assertEqual(self.parser.listings_completed, 1)
+
+  def test_header_parts_do_not_start_listing(self):
+    self.parser.data_received("  MAC address changed\n  Name                  changed\n")
+    self.assertEqual(self.parser.state, controller.IDLE)
+
+    self.parser.data_received("%s\nC  0  |  dc0  |  0x0000000000000001  |  00:22:97:00:00:01\n"
+                              "C - End Station list complete\n" % C_HEADER)
+    self.assertEqual(sorted(self.parser.entities), [1])
+    self.assertEqual(self.parser.listings_completed, 1)
+
+  def test_notifications(self):
+    self.parser.data_received("[NOTIFICATION] (END_STATION_CONNECTED, 0x0000000000000001, 0, 0, 0)\n"
+                              "[NOTIFICATION] (END_STATION_CONNECTED, 0x0000000000000002, 0, 0, 0)\n"
+                              "[NOTIFICATION] (END_STATION_DISCONNECTED, 0x0000000000000001, 0, 0, 0)\n")
+    self.assertEqual(sorted(self.parser.available), [2])
+
+if __name__ == '__main__':
+  unittest.main()
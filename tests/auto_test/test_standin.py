@@ -0,0 +1,216 @@
+""" Tests that the stand-ins print everything the harness expects. The actions of
+    each basics and regressions test are run against a hub emulating a small chain
+    and every expected message is checked against the lines printed since the last
+    check. Run on its own, as it installs the virtual clock:
+
+      python -m unittest test_standin
+"""
+import glob
+import json
+import os
+import random
+import re
+import unittest
+
+import virtual_time
+reactor = virtual_time.install()
+
+from twisted.internet import protocol
+
+from path_setup import *
+
+import xmos.test.base as base
+import xmos.test.generator as generator
+
+import actions
+import analyzers
+import controller
+import endpoints
+import generators
+import graph
+import sequences
+import standin
+import state
+import templates
+
+USER = 'standin'
+CHAIN_LENGTH = 4
+TEST_FOLDERS = ['basics', 'regressions']
+
+def run_until(limit=None):
+  """ Run the timers on the virtual clock until there are none left before the limit
+  """
+  while True:
+    times = [call.getTime() for call in reactor.getDelayedCalls()]
+    if not times or (limit is not None and min(times) > limit):
+      return
+    reactor.now = max(reactor.now, min(times))
+    reactor.runUntilCurrent()
+
+def get_expected_lines(expected, excluded=False):
+  """ Get the (process, pattern, excluded) of every message in a tree of expectations
+  """
+  if isinstance(expected, (list, tuple)):
+    for e in expected:
+      for line in get_expected_lines(e, excluded):
+        yield line
+  elif isinstance(expected, templates.Expected):
+    (process, pattern) = expected.template_args[0][:2]
+    yield (process, pattern, excluded)
+  else:
+    for line in get_expected_lines(expected.template_args[0][0],
+                                   excluded or isinstance(expected, templates.NoneOf)):
+      yield line
+
+class StandinProcess(protocol.ProcessProtocol):
+  """ Collects the lines printed by a stand-in
+  """
+  def __init__(self, name):
+    self.name = name
+    self.lines = []
+
+  def outReceived(self, data):
+    self.lines += data.splitlines()
+
+  def registerErrorPattern(self, pattern):
+    pass
+
+  def unregisterErrorPattern(self, pattern):
+    pass
+
+class StandinController(StandinProcess):
+  def __init__(self, name, controller_type):
+    StandinProcess.__init__(self, name)
+    self.parser = controller.ControllerOutputParser(controller_type, clock=reactor.seconds)
+
+  @property
+  def entities(self):
+    return self.parser.entities
+
+  def outReceived(self, data):
+    StandinProcess.outReceived(self, data)
+    self.parser.data_received(data)
+
+  def wait_for_entities_available(self, guids, timeout):
+    run_until(reactor.seconds() + timeout)
+
+  def wait_for_listing(self, timeout):
+    run_until(reactor.seconds() + timeout)
+
+class StandinMaster(object):
+  """ Passes commands to the stand-ins and runs the clock while waiting
+  """
+  def __init__(self):
+    self.nextExpected = []
+
+  def sendLine(self, name, line):
+    base.getActiveProcesses()[name].transport.write(line + '\n')
+
+  def addExpected(self, expected):
+    self.nextExpected.append(expected)
+
+  def expect(self, expected=None):
+    if expected is not None:
+      run_until(reactor.seconds() + 15)
+
+  def clearExpectHistory(self, name):
+    pass
+
+class Args(object):
+  pass
+
+class StandinTest(unittest.TestCase):
+  def setUp(self):
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    self.config = standin.chain_config(CHAIN_LENGTH, USER)
+    actions.set_sleep_function(lambda seconds: None)
+    actions.expected_templates.clear()
+    state.reset()
+    sequences.get_and_clear_final_port_shaper_states()
+
+  def start(self, controller_type):
+    args = Args()
+    args.user = USER
+    args.controller_type = controller_type
+    args.types = []
+    args.master = StandinMaster()
+    args.controller_id = self.config['controller']['name']
+
+    graph.set_connections(self.config['port_connections'])
+    generators.configure(args, self.config['generators'])
+    analyzers.configure(args, self.config['analyzers'], {})
+    endpoints.configure(args, self.config['endpoints'])
+
+    self.hub = standin.StandinHub(args, args.controller_id)
+    self.processes = base.getActiveProcesses()
+    self.processes.clear()
+    for name in endpoints.get_all().keys() + analyzers.get_all().keys() + generators.get_all().keys():
+      self.processes[name] = StandinProcess(name)
+      self.hub.spawn(self.processes[name], name)
+    self.processes[args.controller_id] = StandinController(args.controller_id, controller_type)
+    self.hub.spawn(self.processes[args.controller_id], args.controller_id)
+    run_until()
+    return args
+
+  def check_expected(self, test_name, command, expected, marks):
+    for (process, pattern, excluded) in get_expected_lines(expected):
+      lines = self.processes[process].lines[marks[process]:]
+      seen = any(re.search(pattern, line) for line in lines)
+      if excluded:
+        self.assertFalse(seen, "%s: '%s' printed '%s' by %s" % (test_name, command, pattern, process))
+      else:
+        self.assertTrue(seen, "%s: '%s' did not print '%s' by %s" % (test_name, command, pattern, process))
+
+  def run_test_file(self, args, test_name):
+    random.seed(1)
+    with open(test_name) as f:
+      test_steps = json.load(f, object_hook=generator.json_hooks)
+
+    for y in actions.action_discover(args, generator.Command("discover"), [], []):
+      pass
+
+    marks = None
+    for test_step in test_steps:
+      state.move_next_to_current()
+      command = test_step.get_command()
+      if command is None:
+        continue
+
+      # Messages are expected from the last check onwards
+      if marks is None:
+        marks = dict((name, len(p.lines)) for (name, p) in self.processes.iteritems())
+
+      action = command.split(' ')
+      expected = []
+      for y in actions.get_action_function(action[0])(args, test_step, expected, action[1:]):
+        pass
+      run_until(reactor.seconds() + 5)
+      self.check_expected(test_name, command, expected, marks)
+
+      if test_step.checkpoint is None or test_step.checkpoint:
+        marks = None
+
+    # Leave the rig as a warm session would for the next test
+    for relay in list(self.hub.model.get_open_relays()):
+      self.hub.close_relay(relay)
+    for c in list(self.hub.model.active_connections.keys()):
+      self.hub.model.disconnect(c.talker.src, c.talker.src_stream, c.listener.dst, c.listener.dst_stream)
+    run_until()
+    state.move_next_to_current()
+    state.reset(state.get_current().talker_on_count)
+    sequences.get_and_clear_final_port_shaper_states()
+
+  def run_tests(self, controller_type):
+    args = self.start(controller_type)
+    for folder in TEST_FOLDERS:
+      for test_name in sorted(glob.glob(os.path.join('configs', folder, '*.json'))):
+        self.run_test_file(args, test_name)
+
+  def test_c_controller(self):
+    self.run_tests('c')
+
+  def test_python_controller(self):
+    self.run_tests('python')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,53 @@
+""" A reactor which runs on a virtual clock.
+
+    Whenever there is nothing left to do the clock jumps straight to the time of the
+    next timer, so sleeps and timeouts take no real time at all while keeping their
+    order. The reactor must be installed before anything imports the default one.
+
+    Only processes which follow the virtual clock themselves (replays and simulated
+    devices) can be used with it, as real processes would not be given any time to
+    respond.
+"""
+import time
+
+from twisted.internet import selectreactor
+
+class VirtualTimeReactor(selectreactor.SelectReactor):
+  def __init__(self):
+    self.now = 0.0
+    self.io_seen = False
+    self.jumps = 0
+    self.real_start = time.time()
+    selectreactor.SelectReactor.__init__(self)
+
+  def seconds(self):
+    return self.now
+
+  def _doReadOrWrite(self, *args):
+    self.io_seen = True
+    return selectreactor.SelectReactor._doReadOrWrite(self, *args)
+
+  def doIteration(self, delay):
+    if delay is None:
+      # No timers, so only input can wake the reactor
+      selectreactor.SelectReactor.doIteration(self, None)
+      return
+
+    # Handle anything which is ready first, as it may add an earlier timer
+    self.io_seen = False
+    selectreactor.SelectReactor.doIteration(self, 0)
+    if not self.io_seen and delay:
+      self.now += delay
+      self.jumps += 1
+
+def option_given(argv, option):
+  """ Check for an option before the arguments can be parsed, as the reactor needs
+      to be installed first.
+  """
+  return any(arg == option or arg.startswith(option + '=') for arg in argv)
+
+def install():
+  from twisted.internet.main import installReactor
+  virtual_reactor = VirtualTimeReactor()
+  installReactor(virtual_reactor)
+  return virtual_reactor